@@ -6,14 +6,17 @@ and ANG_VELOCITY for all rotations.
 @author: Aaron T Becker, Kjell Keune
 """
 import math
+import numpy as np
 from threading import Event
 
 
 class Step:
+    __slots__ = ("angChange", "elevation", "settle")
 
-    def __init__(self, angChange=0, elevation=0):
+    def __init__(self, angChange=0, elevation=0, settle=False):
         self.angChange = angChange
         self.elevation = elevation
+        self.settle = settle  # zero step that only lets the cubes come to rest
 
 class Motion:
     """
@@ -25,6 +28,13 @@ class Motion:
 
     def stepSequence(self, stepTime, longestChain):
         return [Step()]
+
+    def stepArray(self, stepTime, longestChain):
+        """
+        Returns the step sequence as array with one row (angChange, elevation, settle) per step.
+        """
+        steps = self.stepSequence(stepTime, longestChain)
+        return np.array([(step.angChange, step.elevation, step.settle) for step in steps], dtype=float).reshape((-1, 3))
     
     def cost(self):
         return 0
@@ -70,6 +80,12 @@ class PivotWalk(Motion):
         steps.extend(pivotRotationSeq)
         steps.append(Step(0, Tilt.HORIZONTAL))
         return steps
+
+    def stepArray(self, stepTime, longestChain):
+        pivotRotation = Rotation(self.direction * self.pivotAng).stepArray(stepTime, longestChain)
+        pivotRotationInv = Rotation(-2 * self.direction * self.pivotAng).stepArray(stepTime, longestChain)
+        return np.concatenate(([(0, Tilt.SOUTH_DOWN, 0)], pivotRotation, [(0, Tilt.NORTH_DOWN, 0)], pivotRotationInv,
+                               [(0, Tilt.SOUTH_DOWN, 0)], pivotRotation, [(0, Tilt.HORIZONTAL, 0)]))
     
     def cost(self):
         return 4 * abs(self.pivotAng)
@@ -98,9 +114,20 @@ class Rotation(Motion):
         for i in range(updates):
             steps.append(Step(angPerUpdate, 0))
         steps.append(Step(self.angle - updates * angPerUpdate, 0))
-        zeros = [Step() for _ in range(longestChain * Rotation.ROTATION_STALLS)]
+        zeros = [Step(settle=True) for _ in range(longestChain * Rotation.ROTATION_STALLS)]
         steps.extend(zeros)
         return steps
+
+    def stepArray(self, stepTime, longestChain):
+        if self.angle == 0:
+            return np.zeros((1, 3))
+        updates = math.ceil(abs(self.angle) / (Rotation.ANG_VELOCITY * stepTime))
+        angPerUpdate = self.angle / updates
+        steps = np.zeros((updates + 1 + longestChain * Rotation.ROTATION_STALLS, 3))
+        steps[:updates, 0] = angPerUpdate
+        steps[updates, 0] = self.angle - updates * angPerUpdate
+        steps[updates + 1:, 2] = 1
+        return steps
     
     def cost(self):
         return abs(self.angle)
@@ -144,7 +171,12 @@ class Idle(Motion):
         return f"Idle({self.updates}upd)"
 
     def stepSequence(self, stepTime, longestChain):
-        return [Step()] * self.updates
+        return [Step(settle=True)] * self.updates
+
+    def stepArray(self, stepTime, longestChain):
+        steps = np.zeros((self.updates, 3))
+        steps[:, 2] = 1
+        return steps
     
     def cost(self):
         return 0
\ No newline at end of file
@@ -6,6 +6,7 @@ Holds the Configuration class
 import math
 from enum import Enum
 from queue import Queue
+import numpy as np
 from pymunk import Vec2d
 
 from com.motion import PivotWalk, Tilt
@@ -50,6 +51,7 @@ class Cube:
     """
     A unique cube object storing the cube type
     """
+    __slots__ = ("type", "id")
     nextid = 0
     
     TYPE_RED = 0
@@ -59,17 +61,23 @@ class Cube:
     MRAD = 15  # distance of magnet from center of cube
     RAD = 20  # half length of side of cube
     MAG_DISTANCE_MIN = 5 * RAD
+    # position and orientation of the magnets in the frame of the cube, they are the same for all cubes of a type
+    MAGNET_POS = ((-MRAD, 0), (0, -MRAD), (MRAD, 0), (0, MRAD))
+    MAGNET_ORI = {TYPE_RED: ((1, 0), (0, 1), (1, 0), (0, -1)), TYPE_BLUE: ((1, 0), (0, -1), (1, 0), (0, 1))}
 
     def __init__(self, type):
         self.type = type
-        self.magnetPos = [(-Cube.MRAD, 0), (0, -Cube.MRAD), (Cube.MRAD, 0), (0, Cube.MRAD)]
-        if type == Cube.TYPE_RED:
-            self.magnetOri = [(1, 0), (0, 1), (1, 0), (0, -1)]
-        elif type == Cube.TYPE_BLUE:
-            self.magnetOri = [(1, 0), (0, -1), (1, 0), (0, 1)]
         self.id = Cube.nextid
         Cube.nextid += 1
 
+    @property
+    def magnetPos(self):
+        return Cube.MAGNET_POS
+
+    @property
+    def magnetOri(self):
+        return Cube.MAGNET_ORI[self.type]
+
     def __str__(self):
         if self.type == Cube.TYPE_BLUE:
             typeChar = 'b'
@@ -107,13 +115,38 @@ class Cube:
         # print(repr(f) )
         return f
 
+    @staticmethod
+    def magForces1on2(pos1, pos2, ori1, ori2) -> np.ndarray:
+        """
+        Vectorized version of magForce1on2. All parameters are arrays of shape (..., 2),
+        the forces of magnet 1 on magnet 2 are returned with the same shape.
+        """
+        diff = pos2 - pos1
+        r = np.sqrt(diff[..., 0] ** 2 + diff[..., 1] ** 2)
+        r = np.maximum(r, 2*(Cube.RAD-Cube.MRAD))  # limits the amount of force applied
+        rhat = diff / r[..., None]
+        m1r = ori1[..., 0]*rhat[..., 0] + ori1[..., 1]*rhat[..., 1]  # m1 dot rhat
+        m2r = ori2[..., 0]*rhat[..., 0] + ori2[..., 1]*rhat[..., 1]  # m2 dot rhat
+        m1m2 = ori1[..., 0]*ori2[..., 0] + ori1[..., 1]*ori2[..., 1]  # m1 dot m2
+        scale = (Cube.MAG_FORCE*1/r**4)[..., None]
+        return scale * (ori2*m1r[..., None] + ori1*m2r[..., None] + rhat*m1m2[..., None] - 5*rhat*(m1r*m2r)[..., None])
+
 
 class Connection:
+    """
+    cubeA connected to the edgeB of cubeB. Connections are hashed a lot, so the hash is calculated once
+    and the connection must not change afterwards.
+    """
+    __slots__ = ("cubeA", "cubeB", "edgeB", "__hash")
 
     def __init__(self, cubeA: Cube, cubeB: Cube, edgeB: Direction) -> None:
         self.cubeA = cubeA
         self.cubeB = cubeB
         self.edgeB = edgeB
+        if edgeB in (Direction.WEST, Direction.SOUTH):
+            self.__hash = hash((cubeB, cubeA, edgeB.inv()))
+        else:
+            self.__hash = hash((cubeA, cubeB, edgeB))
 
     def __eq__(self, __o: object) -> bool:
         if not type(__o) is Connection:
@@ -122,11 +155,11 @@ class Connection:
         return tup == (__o.cubeA, __o.cubeB, __o.edgeB) or tup == (__o.cubeB, __o.cubeA, __o.edgeB.inv())
     
     def __hash__(self) -> int:
-        if self.edgeB in (Direction.WEST, Direction.SOUTH):
-            tup = (self.cubeB, self.cubeA, self.edgeB.inv())
-        else:
-            tup = (self.cubeA, self.cubeB, self.edgeB)
-        return hash(tup)
+        return self.__hash
+
+    def __reduce__(self):
+        # the hash of a direction differs between processes, so it is calculated again after unpickling
+        return (Connection, (self.cubeA, self.cubeB, self.edgeB))
     
     def __str__(self) -> str:
         return str((self.cubeA,self.cubeB,self.edgeB))
@@ -135,6 +168,92 @@ class Connection:
         return str((self.cubeA,self.cubeB,self.edgeB))
 
 
+class PolyType:
+    """
+    Immutable canonical type of a polyomino. The occupied cells and the red cells are bitboards, cell (x, y)
+    of the bounding box is bit y * width + x. Polyominoes have equal types if their cubes have the same
+    types at the same local coordinates. Types are used as dict keys, so the hash is calculated once.
+    Every type also gets an interned id, equal types have the same id within a process.
+    """
+    __slots__ = ("width", "height", "occupied", "red", "id", "__hash")
+
+    __ids = {}
+
+    def __init__(self, width: int, height: int, occupied: int, red: int):
+        object.__setattr__(self, "width", width)
+        object.__setattr__(self, "height", height)
+        object.__setattr__(self, "occupied", occupied)
+        object.__setattr__(self, "red", red)
+        key = (width, occupied, red)
+        object.__setattr__(self, "id", PolyType.__ids.setdefault(key, len(PolyType.__ids)))
+        object.__setattr__(self, "_PolyType__hash", hash(key))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PolyType is immutable")
+
+    def __reduce__(self):
+        return (PolyType, (self.width, self.height, self.occupied, self.red))
+
+    def size(self) -> int:
+        return self.occupied.bit_count()
+
+    def __eq__(self, __o: object) -> bool:
+        if not type(__o) is PolyType:
+            return False
+        return self.id == __o.id
+
+    def __hash__(self) -> int:
+        return self.__hash
+
+    def __repr__(self) -> str:
+        return f"PolyType({self.width}x{self.height}, {bin(self.occupied)}, {bin(self.red)})"
+
+
+class PolyGeometry:
+    """
+    Facts derived from the local coordinates of a polyomino. Polyomino.geometry caches them until the
+    next connect, so they must not be modified.
+    """
+
+    def __init__(self, cube_pos: dict):
+        self.cubes = tuple(cube_pos.keys())
+        # rows from west to east and columns from south to north, keyed by their local coordinate
+        self.rows = {}
+        self.columns = {}
+        for cube, (x, y) in sorted(cube_pos.items(), key=lambda item: item[1]):
+            self.rows.setdefault(y, []).append(cube)
+            self.columns.setdefault(x, []).append(cube)
+        xmin, xmax = min(self.columns.keys()), max(self.columns.keys())
+        ymin, ymax = min(self.rows.keys()), max(self.rows.keys())
+        self.bounds = (xmax - xmin + 1, ymax - ymin + 1)
+        self.nred = sum(1 for cube in self.cubes if cube.type == Cube.TYPE_RED)
+        # the friction cubes when the field is tilted, see StateHandler
+        self.topRow = self.rows[ymax]
+        self.bottomRow = self.rows[ymin]
+        # pivots of a pivot walk in local coordinates (in cube widths), the middle of the north edges
+        # of the top row and the south edges of the bottom row
+        self.pivotN = Vec2d(sum(cube_pos[cube][0] for cube in self.topRow) / len(self.topRow), ymax + 0.5)
+        self.pivotS = Vec2d(sum(cube_pos[cube][0] for cube in self.bottomRow) / len(self.bottomRow), ymin - 0.5)
+        # bitboards of the rows from south to north, bit x - xmin is the cube at local x
+        self.xmin = xmin
+        self.ymin = ymin
+        rowMasks = [0] * self.bounds[1]
+        redRowMasks = [0] * self.bounds[1]
+        for cube, (x, y) in cube_pos.items():
+            rowMasks[y - ymin] |= 1 << (x - xmin)
+            if cube.type == Cube.TYPE_RED:
+                redRowMasks[y - ymin] |= 1 << (x - xmin)
+        self.rowMasks = tuple(rowMasks)
+        self.redRowMasks = tuple(redRowMasks)
+        width = self.bounds[0]
+        occupied = 0
+        red = 0
+        for i in range(self.bounds[1]):
+            occupied |= rowMasks[i] << (i * width)
+            red |= redRowMasks[i] << (i * width)
+        self.type = PolyType(width, self.bounds[1], occupied, red)
+
+
 class Polyomino:
 
     nextId = 0
@@ -147,6 +266,7 @@ class Polyomino:
         self.ymin = 0
         self.ymax = 0
         self.__valid = True
+        self.__geometry = None
         self.id = Polyomino.nextId
         Polyomino.nextId += 1
         # The root should allways be the most left most bottom cube.
@@ -172,6 +292,7 @@ class Polyomino:
         # add cubeA
         self.__cube_pos[cubeA] = posA
         self.__pos_cube[posA] = cubeA
+        self.__geometry = None
         # update the bounds
         self.xmin = min(posA[0], self.xmin)
         self.xmax = max(posA[0], self.xmax)
@@ -223,7 +344,7 @@ class Polyomino:
         return map
 
     def getCubes(self):
-        return list(self.__cube_pos.keys())
+        return list(self.geometry().cubes)
 
     def getCube(self, localCoords) -> Cube:
         try:
@@ -238,28 +359,30 @@ class Polyomino:
         return self.__cube_pos[cube]
 
     def getBottomRow(self):
-        return self.__getRow__(self.ymin)
+        return list(self.geometry().bottomRow)
 
     def getTopRow(self):
-        return self.__getRow__(self.ymax)
+        return list(self.geometry().topRow)
 
     def __getRow__(self, y):
-        cubes = []
-        for x in range(self.xmin, self.xmax + 1):
-            try:
-                cubes.append(self.__pos_cube[(x, y)])
-            except KeyError:
-                continue
-        return cubes
+        return list(self.geometry().rows.get(y, []))
 
     def __getColum__(self, x):
-        cubes = []
-        for y in range(self.ymin, self.ymax + 1):
-            try:
-                cubes.append(self.__pos_cube[(x, y)])
-            except KeyError:
-                continue
-        return cubes
+        return list(self.geometry().columns.get(x, []))
+
+    def polyType(self) -> PolyType:
+        """
+        Returns the canonical type of the polyomino, it changes with every connect.
+        """
+        return self.geometry().type
+
+    def geometry(self) -> PolyGeometry:
+        """
+        Returns the rows, columns, bounds and pivots of the polyomino, they are only derived again after a connect.
+        """
+        if self.__geometry is None:
+            self.__geometry = PolyGeometry(self.__cube_pos)
+        return self.__geometry
 
     def isTrivial(self) -> bool:
         return len(self.__cube_pos) == 1
@@ -271,79 +394,159 @@ class Polyomino:
         return len(self.__cube_pos)
     
     def nred(self) -> int:
-        nred = 0
-        for cube in self.__pos_cube.values():
-            if cube.type == Cube.TYPE_RED:
-                nred += 1
-        return nred
+        return self.geometry().nred
 
     def contains(self, cube: Cube):
         return cube in self.__cube_pos
 
     def bounds(self):
-        return (self.xmax - self.xmin + 1, self.ymax - self.ymin + 1)
+        return self.geometry().bounds
 
     def connectPoly(self, cubeA: Cube, polyB, cubeB: Cube, edgeB: Direction):
+        """
+        Returns the polyomino formed when cubeA of this polyomino connects to edgeB of cubeB in polyB,
+        None if the two would overlap or are the same polyomino.
+        """
         if ((not self.contains(cubeA)) or (not polyB.contains(cubeB))):
             return
-        poly = polyB.clone()
-        if not poly.connect(cubeA, cubeB, edgeB):
+        if polyB.contains(cubeA):
             return None
-        done = set()
-        next = Queue()
-        done.add(cubeA)
-        next.put(cubeA)
-        while not next.empty():
-            current = next.get()
-            for i, adj in enumerate(self.getConnected(current)):
-                if (adj == None) or (adj in done):
-                    continue
-                if not poly.connect(adj, current, Direction(i)):
-                    return None
-                done.add(adj)
-                next.put(adj)
+        offset, rows = self.__alignRows__(cubeA, polyB, cubeB, edgeB)
+        valid = polyB.__valid
+        for a, aRed, b, bRed in rows:
+            if a & b:
+                return None
+            # same types next to each other, where at least one of the two is from this polyomino
+            red = aRed | bRed
+            blue = (a | b) & ~red
+            if ((red & (red >> 1)) | (blue & (blue >> 1))) & (a | (a >> 1)):
+                valid = False
+        # cubes of polyB in the order of a clone, then the cubes of this polyomino breadth first from cubeA
+        cube_pos = {polyB.getRoot(): (0, 0)}
+        cube_pos.update(polyB.__cube_pos)
+        for cube in self.__breadthFirst__(cubeA):
+            pos = self.__cube_pos[cube]
+            cube_pos[cube] = (pos[0] + offset[0], pos[1] + offset[1])
+        root = min(cube_pos.values())
+        poly = Polyomino(polyB.getRoot())
+        poly.__cube_pos = {cube: (pos[0] - root[0], pos[1] - root[1]) for cube, pos in cube_pos.items()}
+        poly.__pos_cube = {pos: cube for cube, pos in poly.__cube_pos.items()}
+        poly.__valid = valid
+        poly.xmin = min(polyB.xmin, self.xmin + offset[0]) - root[0]
+        poly.xmax = max(polyB.xmax, self.xmax + offset[0]) - root[0]
+        poly.ymin = min(polyB.ymin, self.ymin + offset[1]) - root[1]
+        poly.ymax = max(polyB.ymax, self.ymax + offset[1]) - root[1]
         return poly
     
     def connectPolyPossible(self, cubeA: Cube, polyB, cubeB: Cube, edgeB: Direction, direction: Direction, target=None) -> bool:
-        # check if connecting the polys creates a vaild target
-        if target == None:
-            target = self.connectPoly(cubeA, polyB, cubeB, edgeB)
-        if target == None:
-            return False
         # if we walk in from east then edgeB has to be west ang the other way around
         if edgeB == direction:
             return False
-        if direction == Direction.EAST:
-            end = target.xmin - 1
-            step = -1
-        elif direction == Direction.WEST:
-            end = target.xmax + 1
-            step = 1
-        else:
+        if direction != Direction.EAST and direction != Direction.WEST:
             return False
-        for cube in self.getCubes():
-            posInTar = target.__cube_pos[cube]
-            for x in range(posInTar[0], end, step):
-                try:
-                    cubeInTar = target.__pos_cube[(x,posInTar[1])]
-                except KeyError:
-                    continue
-                if not self.contains(cubeInTar):
+        if target != None:
+            rows = self.__splitRows__(target)
+        elif (not self.contains(cubeA)) or (not polyB.contains(cubeB)) or polyB.contains(cubeA):
+            return False
+        else:
+            rows = self.__alignRows__(cubeA, polyB, cubeB, edgeB)[1]
+        # no cube of polyB may be in a row of this polyomino on the side we come from
+        for a, _, b, _ in rows:
+            if a & b:
+                return False
+            if direction == Direction.EAST:
+                if b & ((1 << a.bit_length()) - 1):
                     return False
+            elif b & -(a & -a):
+                return False
         return True
 
+    def __alignRows__(self, cubeA: Cube, polyB, cubeB: Cube, edgeB: Direction):
+        # the offset moving this polyomino into the coordinates of polyB, so that cubeA is at edgeB of cubeB,
+        # and for every row of this polyomino the bitboards (all, red) of both in a shared frame
+        posA = self.__cube_pos[cubeA]
+        posB = polyB.__cube_pos[cubeB]
+        if edgeB == Direction.NORTH:
+            offset = (posB[0] - posA[0], posB[1] + 1 - posA[1])
+        elif edgeB == Direction.EAST:
+            offset = (posB[0] + 1 - posA[0], posB[1] - posA[1])
+        elif edgeB == Direction.SOUTH:
+            offset = (posB[0] - posA[0], posB[1] - 1 - posA[1])
+        else:
+            offset = (posB[0] - 1 - posA[0], posB[1] - posA[1])
+        geoA = self.geometry()
+        geoB = polyB.geometry()
+        xmin = min(geoA.xmin + offset[0], geoB.xmin)
+        shiftA = geoA.xmin + offset[0] - xmin
+        shiftB = geoB.xmin - xmin
+        rowOffset = geoA.ymin + offset[1] - geoB.ymin
+        rows = []
+        for i, a in enumerate(geoA.rowMasks):
+            j = i + rowOffset
+            if 0 <= j < len(geoB.rowMasks):
+                b = geoB.rowMasks[j] << shiftB
+                bRed = geoB.redRowMasks[j] << shiftB
+            else:
+                b = bRed = 0
+            rows.append((a << shiftA, geoA.redRowMasks[i] << shiftA, b, bRed))
+        return offset, rows
+
+    def __splitRows__(self, target):
+        # for every row of target the bitboards (all, red) of the cubes from this polyomino and of the others
+        geo = target.geometry()
+        rows = []
+        for y in range(geo.ymin, geo.ymin + geo.bounds[1]):
+            a = aRed = b = bRed = 0
+            for cube in geo.rows[y]:
+                bit = 1 << (target.__cube_pos[cube][0] - geo.xmin)
+                red = bit if cube.type == Cube.TYPE_RED else 0
+                if self.contains(cube):
+                    a |= bit
+                    aRed |= red
+                else:
+                    b |= bit
+                    bRed |= red
+            rows.append((a, aRed, b, bRed))
+        return rows
+
+    def __breadthFirst__(self, start: Cube):
+        # the cubes in the order a breadth first search from start visits them, neighbors from north to west
+        order = [start]
+        done = {start}
+        i = 0
+        while i < len(order):
+            x, y = self.__cube_pos[order[i]]
+            i += 1
+            for pos in ((x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)):
+                adj = self.__pos_cube.get(pos)
+                if adj != None and not adj in done:
+                    done.add(adj)
+                    order.append(adj)
+        return order
+
     def clone(self):
         clone = Polyomino(self.getRoot())
         for cube, pos in self.__cube_pos.items():
             clone.__cube_pos[cube] = pos
             clone.__pos_cube[pos] = cube
         clone.__valid = self.__valid
+        clone.__geometry = self.__geometry
         clone.xmax = self.xmax
         clone.xmin = self.xmin
         clone.ymax = self.ymax
         clone.ymin = self.ymin
         return clone
 
+    def mapCubes(self, cube_map: dict):
+        """
+        Returns a clone of the polyomino where every cube is replaced by cube_map[cube].
+        """
+        mapped = self.clone()
+        mapped.__pos_cube = {pos: cube_map[cube] for pos, cube in self.__pos_cube.items()}
+        mapped.__cube_pos = {cube_map[cube]: pos for cube, pos in self.__cube_pos.items()}
+        mapped.__geometry = None
+        return mapped
+
     def __updateCoordinates__(self, newRoot):
         self.__pos_cube.clear()
         posUpdate = self.__cube_pos[newRoot]
@@ -351,7 +554,7 @@ class Polyomino:
         self.xmax -= posUpdate[0]
         self.ymin -= posUpdate[1]
         self.ymax -= posUpdate[1]
-        for cube in self.getCubes():
+        for cube in list(self.__cube_pos.keys()):
             posOld = self.__cube_pos[cube]
             posNew = (posOld[0] - posUpdate[0], posOld[1] - posUpdate[1])
             self.__pos_cube[posNew] = cube
@@ -360,21 +563,10 @@ class Polyomino:
     def __eq__(self, __o: object) -> bool:
         if not type(__o) is Polyomino:
             return False
-        if self.size() != __o.size():
-            return False
-        for cubeT in self.getCubes():
-            posT = self.__cube_pos[cubeT]
-            try:
-                if cubeT.type != __o.__pos_cube[posT].type:
-                    return False
-            except KeyError:
-                return False
-        return True
+        return self.polyType() == __o.polyType()
 
     def __hash__(self) -> int:
-        toHash = [(p, c.type) for p, c in self.__pos_cube.items()]
-        toHash.sort(key=lambda t: t[0])
-        return hash(tuple(toHash))
+        return hash(self.polyType())
 
     def __str__(self) -> str:
         string = f""
@@ -394,12 +586,16 @@ class Polyomino:
    
 class PolyCollection:
 
+    # interned fingerprints, the sorted (type id, count) pairs of a collection to its fingerprint
+    __fingerprints = {}
+
     def __init__(self, polys=None):
         self.maxWidth = 0
         self.maxHeight = 0
         self.maxSize = 0
         self.__valid = True
         self.__polyType_polys = {}
+        self.__fingerprint = None
         self.cube_poly = {}
         if polys == None:
             return
@@ -408,9 +604,32 @@ class PolyCollection:
 
     def detectPolyominoes(self, connects: dict):
         self.__clear__()
+        self.__detect__(connects, connects.keys())
+
+    def updatePolyominoes(self, connects: dict, changed):
+        """
+        Only detects the polyominoes again that contain a cube in changed.
+        All other polyominoes keep their identity.
+        """
+        # polys are compared by their type, so they are identified by their object id
+        dirty = {}
+        cubes = []
+        for cube in changed:
+            if cube in self.cube_poly:
+                poly = self.cube_poly[cube]
+                dirty[id(poly)] = poly
+            elif cube in connects:
+                cubes.append(cube)
+        for poly in dirty.values():
+            self.__remove__(poly)
+            cubes.extend(poly.getCubes())
+        self.__updateBounds__()
+        self.__detect__(connects, cubes)
+
+    def __detect__(self, connects: dict, cubes):
         done = set()
         next = Queue()
-        for cube in connects.keys():
+        for cube in cubes:
             if cube in done:
                 continue
             polyomino = Polyomino(cube)
@@ -434,13 +653,21 @@ class PolyCollection:
     def getForCube(self, cube: Cube)-> Polyomino:
         return self.cube_poly[cube]
 
-    def getForType(self, type: Polyomino) -> list:
-        if not type in self:
+    def getForType(self, type) -> list:
+        """
+        Returns the polyominoes of the type, given as PolyType or as a polyomino of that type.
+        """
+        if isinstance(type, Polyomino):
+            type = type.polyType()
+        if not type in self.__polyType_polys:
             return []
         return self.__polyType_polys[type]
 
     def getTypes(self) -> list:
-        return list(self.__polyType_polys.keys())
+        """
+        Returns one polyomino of each type.
+        """
+        return [polys[0] for polys in self.__polyType_polys.values()]
 
     def getAll(self) -> list:
         if len(self.__polyType_polys) == 0:
@@ -458,25 +685,56 @@ class PolyCollection:
         return not self.__valid
 
     def __add__(self, poly: Polyomino):
-        bounds = poly.bounds()
+        geometry = poly.geometry()
+        bounds = geometry.bounds
         self.maxWidth = max(self.maxWidth, bounds[0]) 
         self.maxHeight = max(self.maxHeight, bounds[1])
-        self.maxSize = max(self.maxSize, poly.size())
+        self.maxSize = max(self.maxSize, len(geometry.cubes))
         if not poly.isValid():
             self.__valid = False
-        if poly in self.__polyType_polys:
-            self.__polyType_polys[poly].append(poly)
+        if geometry.type in self.__polyType_polys:
+            self.__polyType_polys[geometry.type].append(poly)
         else:
-            self.__polyType_polys[poly] = [poly]
-        for cube in poly.getCubes():
+            self.__polyType_polys[geometry.type] = [poly]
+        self.__fingerprint = None
+        for cube in geometry.cubes:
             self.cube_poly[cube] = poly
 
+    def __remove__(self, poly: Polyomino):
+        polyType = poly.polyType()
+        polys = self.__polyType_polys[polyType]
+        for i, other in enumerate(polys):
+            if other is poly:
+                del polys[i]
+                break
+        if len(polys) == 0:
+            del self.__polyType_polys[polyType]
+        self.__fingerprint = None
+        for cube in poly.geometry().cubes:
+            del self.cube_poly[cube]
+
+    def __updateBounds__(self):
+        # bounds and validity have to be determined again after polys got removed
+        self.maxWidth = 0
+        self.maxHeight = 0
+        self.maxSize = 0
+        self.__valid = True
+        for poly in self.getAll():
+            geometry = poly.geometry()
+            bounds = geometry.bounds
+            self.maxWidth = max(self.maxWidth, bounds[0]) 
+            self.maxHeight = max(self.maxHeight, bounds[1])
+            self.maxSize = max(self.maxSize, len(geometry.cubes))
+            if not poly.isValid():
+                self.__valid = False
+
     def __clear__(self):
         self.maxWidth = 0
         self.maxHeight = 0
         self.maxSize = 0
         self.__valid = True
         self.__polyType_polys.clear()
+        self.__fingerprint = None
         self.cube_poly.clear()
 
     def polyCount(self):
@@ -486,23 +744,34 @@ class PolyCollection:
         return count
 
     def __contains__(self, key):
+        if isinstance(key, Polyomino):
+            key = key.polyType()
         return key in self.__polyType_polys
     
+    def fingerprint(self) -> int:
+        """
+        Returns an id for the multiset of poly types in the collection. Collections with the same number of
+        polyominoes of each type have the same fingerprint within a process. It is only determined again
+        after polyominoes were added or removed.
+        """
+        if self.__fingerprint is None:
+            key = tuple(sorted((type.id, len(polys)) for type, polys in self.__polyType_polys.items()))
+            self.__fingerprint = PolyCollection.__fingerprints.setdefault(key, len(PolyCollection.__fingerprints))
+        return self.__fingerprint
+
+    def __getstate__(self):
+        # type ids and fingerprints are only valid in the process that interned them
+        state = self.__dict__.copy()
+        state["_PolyCollection__fingerprint"] = None
+        return state
+
     def __eq__(self, __o: object) -> bool:
         if not type(__o) is PolyCollection:
             return False
-        for key in self.__polyType_polys.keys():
-            try:
-                if len(__o.__polyType_polys[key]) != len(self.__polyType_polys[key]):
-                    return False
-            except KeyError:
-                return False
-        return True
+        return self.fingerprint() == __o.fingerprint()
     
     def __hash__(self) -> int:
-        toHash = [(hash(k), len(v)) for k, v in self.__polyType_polys.items()]
-        toHash.sort()
-        return hash(tuple(toHash))
+        return self.fingerprint()
 
     def __str__(self) -> str: 
         strId = str(hex(id(self)))[-4:]
@@ -525,53 +794,80 @@ class Configuration:
 
     It also stores additional information about the polyominoes present
     if it was loaded and updated by a simulation
+
+    Positions, angles and velocities are kept in arrays with one row per cube. The polyomino
+    collection and the center of mass and pivots of a polyomino are only calculated when asked for.
     """
 
     def __init__(self, boardSize, magAng, cube_pos:dict, cube_meta:dict=None, polys:list=None,  magElev=Tilt.HORIZONTAL):
+        cubes = list(cube_pos.keys())
+        pos = np.array([tuple(cube_pos[cube]) for cube in cubes], dtype=float).reshape((-1, 2))
+        if cube_meta == None:
+            ang = np.full(len(cubes), magAng, dtype=float)
+            vel = np.zeros((len(cubes), 2))
+        else:
+            ang = np.array([cube_meta[cube][0] for cube in cubes], dtype=float)
+            vel = np.array([tuple(cube_meta[cube][1]) for cube in cubes], dtype=float).reshape((-1, 2))
+        self.__initState__(boardSize, magAng, magElev, cubes, None, pos, ang, vel, polys)
+
+    @staticmethod
+    def fromArrays(boardSize, magAng, cubes: list, pos, ang, vel, polys: list=None, magElev=Tilt.HORIZONTAL, cube_index: dict=None):
+        """
+        Creates a configuration from arrays without copying them, row k of pos, ang and vel belongs to cubes[k].
+
+        Parameters:
+            cube_index: the index of every cube in cubes, it is shared with the configuration and must not change
+        """
+        config = Configuration.__new__(Configuration)
+        config.__initState__(boardSize, magAng, magElev, cubes, cube_index, pos, ang, vel, polys)
+        return config
+
+    def __initState__(self, boardSize, magAng, magElev, cubes, cube_index, pos, ang, vel, polys):
         self.magAngle = magAng  # orientation of magnetic field (in radians)
         self.magElevation = magElev
         self.boardSize = boardSize
-        self.__cube_data = {}
-        for cube, pos in cube_pos.items():
-            if cube_meta == None:
-                meta = (magAng, (0, 0))
-            else:
-                meta = cube_meta[cube]
-            self.__cube_data[cube] = (pos, meta[0], meta[1])
+        self.__cubes = cubes
+        self.__cube_index = cube_index
+        self.__pos = pos
+        self.__ang = ang
+        self.__vel = vel
+        self.__polys = polys
+        self.__polyominoes = None
         self.__poly_meta = {}
-        if polys != None:
-            for poly in polys:
-                com = self.__calcCOM__(poly)
-                pn = self.__calcPivotN__(poly)
-                ps = self.__calcPivotS__(poly)
-                self.__poly_meta[poly.id] = (com, pn, ps)
-        self.__polyominoes = PolyCollection(polys)
+
+    def getArrays(self):
+        """
+        Returns the cubes and the arrays of their positions, angles and velocities. They must not be modified.
+        """
+        return self.__cubes, self.__pos, self.__ang, self.__vel
 
     def getCubes(self):
-        return list(self.__cube_data.keys())
+        return list(self.__cubes)
 
     def getPosition(self, cube: Cube) -> Vec2d:
-        pos = self.__cube_data[cube][0]
-        return Vec2d(pos[0], pos[1])
+        pos = self.__pos[self.__indexOf__(cube)]
+        return Vec2d(float(pos[0]), float(pos[1]))
 
     def getAngle(self, cube: Cube):
-        return self.__cube_data[cube][1]
+        return float(self.__ang[self.__indexOf__(cube)])
 
     def getVelocity(self, cube: Cube) -> Vec2d:
-        vel = self.__cube_data[cube][2]
-        return Vec2d(vel[0], vel[1])
+        vel = self.__vel[self.__indexOf__(cube)]
+        return Vec2d(float(vel[0]), float(vel[1]))
 
     def getPolyominoes(self) -> PolyCollection:
+        if self.__polyominoes is None:
+            self.__polyominoes = PolyCollection(self.__polys)
         return self.__polyominoes
 
     def getCOM(self, poly: Polyomino) -> Vec2d:
-        return self.__poly_meta[poly.id][0]
+        return self.__polyMeta__(poly)[0]
 
     def getPivotN(self, poly: Polyomino) -> Vec2d:
-        return self.__poly_meta[poly.id][1]
+        return self.__polyMeta__(poly)[1]
     
     def getPivotS(self, poly: Polyomino) -> Vec2d:
-        return self.__poly_meta[poly.id][2]
+        return self.__polyMeta__(poly)[2]
 
     def getPivotWalkingDistance(self, poly: Polyomino, pivotAng):
         axis = self.getPivotN(poly) - self.getPivotS(poly)
@@ -590,9 +886,9 @@ class Configuration:
         return vecWalk
 
     def nearestWall(self, cube) -> Direction:
-        if not cube in self.__cube_data:
+        if not cube in self.__indices__():
             return
-        pos = self.__cube_data[cube]
+        pos = self.getPosition(cube)
         dis = [pos[1], abs(self.boardSize[0] - pos[0]), abs(self.boardSize[1] - pos[1]), pos[0]]
         return Direction(dis.index(min(dis)))
 
@@ -600,22 +896,36 @@ class Configuration:
         return pos[0] < self.boardSize[0] and pos[0] >= 0 and pos[1] < self.boardSize[1] and pos[1] >= 0 
 
     def posCubeOverlap(self, pos: Vec2d):
-        for cube in self.getCubes():
-            # TODO dont compare in circle compare in rect
-            if pos.get_distance(self.getPosition(cube)) <= Cube.RAD * 1.5:
-                return True
-        return False
+        # TODO dont compare in circle compare in rect
+        diff = self.__pos - (pos[0], pos[1])
+        return bool(np.any(np.sqrt(diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1]) <= Cube.RAD * 1.5))
+
+    def __indices__(self) -> dict:
+        if self.__cube_index is None:
+            self.__cube_index = {cube: n for n, cube in enumerate(self.__cubes)}
+        return self.__cube_index
+
+    def __indexOf__(self, cube: Cube) -> int:
+        if self.__cube_index is None:
+            self.__indices__()
+        return self.__cube_index[cube]
+
+    def __polyMeta__(self, poly: Polyomino):
+        if not poly.id in self.__poly_meta:
+            self.__poly_meta[poly.id] = (self.__calcCOM__(poly), self.__calcPivotN__(poly), self.__calcPivotS__(poly))
+        return self.__poly_meta[poly.id]
 
     def __calcCOM__(self, poly: Polyomino) -> Vec2d:
         com = Vec2d(0,0)
-        for cube in poly.getCubes():
+        cubes = poly.geometry().cubes
+        for cube in cubes:
             com += self.getPosition(cube)
-        com /= poly.size()
+        com /= len(cubes)
         return com
         
     def __calcPivotN__(self, poly: Polyomino) -> Vec2d:
         pn = Vec2d(0,0)
-        topRow = poly.getTopRow()
+        topRow = poly.geometry().topRow
         for cube in topRow:
             pn += (self.getPosition(cube) + Cube.RAD * Direction.NORTH.vec(self.getAngle(cube)))
         pn /= len(topRow)
@@ -623,7 +933,7 @@ class Configuration:
 
     def __calcPivotS__(self, poly: Polyomino) -> Vec2d:
         ps = Vec2d(0,0)
-        bottomRow = poly.getBottomRow()
+        bottomRow = poly.geometry().bottomRow
         for cube in bottomRow:
             ps += (self.getPosition(cube) + Cube.RAD * Direction.SOUTH.vec(self.getAngle(cube)))
         ps /= len(bottomRow)
@@ -633,7 +943,7 @@ class Configuration:
         return hash(self) == hash(__o)
 
     def __hash__(self) -> int:
-        toHash = [(d[0], c.type) for c, d in self.__cube_data.items()]
+        toHash = [((pos[0], pos[1]), c.type) for c, pos in zip(self.__cubes, self.__pos.tolist())]
         toHash.sort()
         toHash.append(self.magAngle)
         return hash(tuple(toHash))
@@ -654,4 +964,20 @@ class Configuration:
     def addCube(self, cube, pos, ang=None, vel=(0,0)):
         if ang == None:
             ang = self.magAngle
-        self.__cube_data[cube] = (pos, ang, vel)
+        indices = self.__indices__()
+        if cube in indices:
+            n = indices[cube]
+            self.__pos = self.__pos.copy()
+            self.__ang = self.__ang.copy()
+            self.__vel = self.__vel.copy()
+            self.__pos[n] = tuple(pos)
+            self.__ang[n] = ang
+            self.__vel[n] = tuple(vel)
+        else:
+            # the cube list and index might be shared, so they are replaced instead of changed
+            self.__cube_index = {**indices, cube: len(self.__cubes)}
+            self.__cubes = self.__cubes + [cube]
+            self.__pos = np.concatenate((self.__pos, [tuple(pos)]))
+            self.__ang = np.append(self.__ang, ang)
+            self.__vel = np.concatenate((self.__vel, [tuple(vel)]))
+        self.__poly_meta.clear()
@@ -3,111 +3,169 @@ from queue import Queue
 from com.state import Configuration, PolyCollection, Polyomino, Connection, Direction, Cube
 from plan.plan import *
 import plan.localp as local
-import copy
 
 
-class MonotoneCuttingPath:
+class MonotoneCuttingPaths:
+    """
+    Enumerates the monotone cutting paths of a polyomino. A path walks along the edges between cells and never
+    in the inverse of a direction it walked before, so it crosses every connection at most once. Paths with the
+    same prefix share it: a path is only its last step, the directions still available and a bitmask of the
+    connections it crossed, bit 4 * i + edge for the edge of the i-th cube. Paths in the same state are only
+    followed once and every set of crossed connections is only cut once.
+    """
 
-    def __init__(self, poly: Polyomino, cube: Cube, edge: Direction, edgeOri: Direction) -> None:
+    def __init__(self, poly: Polyomino) -> None:
         self.__poly = poly
-        self.__path = [(cube, edge, edgeOri)]
-        self.__oriAvailable = set(Direction.list())
-        self.__oriAvailable.difference_update([edgeOri.inv()])
+        self.__cubes = poly.getCubes()
+        index = {cube: i for i, cube in enumerate(self.__cubes)}
+        # index of the cube connected at each edge, -1 if there is none
+        self.__adj = [[-1 if adj == None else index[adj] for adj in poly.getConnected(cube)] for cube in self.__cubes]
+        self.__mask_cut = {}
+        self.__mask_connection = {}
 
-    def cutPoly(self) -> PolyCollection:
-        connects = self.__poly.getConnectionMap()
-        for cube, edge, ori in self.__path:
-            conCube = self.__poly.getConnectedAt(cube, edge)
-            if conCube != None:
-                connects[cube][edge.value] = None
-                connects[conCube][edge.inv().value] = None
-        pc = PolyCollection()
-        pc.detectPolyominoes(connects)
-        return pc
+    def twoCuts(self) -> dict:
+        """
+        Returns the cuts into two polyominoes, each with the connections the paths cutting it crossed.
+        """
+        twoCuts = {}
+        done = set()
+        for i, adjs in enumerate(self.__adj):
+            for edge in range(4):
+                if adjs[edge] == -1:
+                    continue
+                ori = (edge + 1) % 4
+                start = (i, edge, ori, 15 & ~(1 << ((ori + 2) % 4)), 1 << (4 * i + edge))
+                if start in done:
+                    continue
+                done.add(start)
+                for cut, cons in self.__cutsFrom(start, done).items():
+                    if not cut in twoCuts:
+                        twoCuts[cut] = cons
+                    else:
+                        twoCuts[cut].update(cons)
+        return twoCuts
+
+    def __cutsFrom(self, start: tuple, done: set) -> dict:
+        # breadth first, paths in a state that was already followed from here or an earlier start are skipped
+        twoCuts = {}
+        next = [start]
+        k = 0
+        while k < len(next):
+            state = next[k]
+            k += 1
+            extended = self.__extended(state)
+            if len(extended) == 0:
+                cut = self.__cutPoly(state[4])
+                if cut == None:
+                    continue
+                if not cut in twoCuts:
+                    twoCuts[cut] = set([self.__pickConnection(state[4])])
+                else:
+                    twoCuts[cut].add(self.__pickConnection(state[4]))
+                continue
+            for ext in extended:
+                if not ext in done:
+                    done.add(ext)
+                    next.append(ext)
+        return twoCuts
+
+    def __extended(self, state: tuple) -> list:
+        cube, edge, ori, available, crossed = state
+        adj = self.__adj
+        # determine the 3 cubes relevant for extention
+        cEdge = adj[cube][edge]
+        cOri = adj[cube][ori]
+        if cOri != -1:
+            cDiag = adj[cOri][edge]
+        elif cEdge != -1:
+            cDiag = adj[cEdge][ori]
+        else:
+            cDiag = -1
+        # find valid path extentions in up to 3 directions
+        ext = []
+        edgeInv = (edge + 2) % 4
+        if available & (1 << edgeInv):
+            ext.append((cube, ori, edgeInv))
+        if available & (1 << edge):
+            if cEdge != -1:
+                ext.append((cEdge, ori, edge))
+            elif cDiag != -1:
+                ext.append((cDiag, (ori + 2) % 4, edge))
+        if available & (1 << ori):
+            if cOri != -1:
+                ext.append((cOri, edge, ori))
+            elif cDiag != -1:
+                ext.append((cDiag, edgeInv, ori))
+        states = []
+        for c, e, o in ext:
+            if adj[c][e] != -1:
+                states.append((c, e, o, available & ~(1 << ((o + 2) % 4)), crossed | (1 << (4 * c + e))))
+            else:
+                states.append((c, e, o, available & ~(1 << ((o + 2) % 4)), crossed))
+        return states
+
+    def __cutPoly(self, crossed: int) -> PolyCollection:
+        # the two polyominoes left after removing the crossed connections, None if it are more or less
+        adj = self.__adj
+        removed = crossed
+        for bit in self.__bits(crossed):
+            removed |= 1 << (4 * adj[bit >> 2][bit & 3] + (bit + 2) % 4)
+        if removed in self.__mask_cut:
+            return self.__mask_cut[removed]
+        parts = 0
+        reached = 0
+        for start in range(len(adj)):
+            if reached & (1 << start):
+                continue
+            parts += 1
+            reached |= 1 << start
+            stack = [start]
+            while len(stack) > 0:
+                i = stack.pop()
+                for edge, j in enumerate(adj[i]):
+                    if j != -1 and not reached & (1 << j) and not removed & (1 << (4 * i + edge)):
+                        reached |= 1 << j
+                        stack.append(j)
+        cut = None
+        if parts == 2:
+            connects = self.__poly.getConnectionMap()
+            for bit in self.__bits(crossed):
+                cube = self.__cubes[bit >> 2]
+                conCube = self.__cubes[adj[bit >> 2][bit & 3]]
+                connects[cube][bit & 3] = None
+                connects[conCube][(bit + 2) % 4] = None
+            cut = PolyCollection()
+            cut.detectPolyominoes(connects)
+        self.__mask_cut[removed] = cut
+        return cut
 
-    def pickConnection(self) -> Connection:
+    def __pickConnection(self, crossed: int) -> Connection:
+        if crossed in self.__mask_connection:
+            return self.__mask_connection[crossed]
         connections = []
-        for cube, edge, ori in self.__path:
-            conCube = self.__poly.getConnectedAt(cube, edge)
-            if conCube != None:
-                connections.append(Connection(conCube, cube, edge))
+        for bit in self.__bits(crossed):
+            conCube = self.__cubes[self.__adj[bit >> 2][bit & 3]]
+            connections.append(Connection(conCube, self.__cubes[bit >> 2], Direction(bit & 3)))
         connections.sort(key=lambda con: hash(con))
         # north-south conections are preferred for planning
+        picked = connections[-1]
         for con in connections:
             if con.edgeB in (Direction.NORTH, Direction.SOUTH):
-                return con
-        return con
+                picked = con
+                break
+        self.__mask_connection[crossed] = picked
+        return picked
 
-    def extendedPaths(self):
-        lastCube, lastEdge, lastOri = self.__path[len(self.__path) - 1]
-        # determine the 3 cubes relevant for extention
-        cEdge = self.__poly.getConnectedAt(lastCube, lastEdge)
-        cOri = self.__poly.getConnectedAt(lastCube, lastOri)
-        if cOri != None:
-            cDiag = self.__poly.getConnectedAt(cOri, lastEdge)
-        elif cEdge != None:
-            cDiag = self.__poly.getConnectedAt(cEdge, lastOri)
-        else:
-            cDiag = None
-        # find valid path extentions in up to 3 directions
-        ext = []
-        if lastEdge.inv() in self.__oriAvailable:
-            ext.append((lastCube, lastOri, lastEdge.inv()))
-        if lastEdge in self.__oriAvailable:
-            if cEdge != None:
-                ext.append((cEdge, lastOri, lastEdge))
-            elif cDiag != None:
-                ext.append((cDiag, lastOri.inv(), lastEdge))
-        if lastOri in self.__oriAvailable:
-            if cOri != None:
-                ext.append((cOri, lastEdge, lastOri))
-            elif cDiag != None:
-                ext.append((cDiag, lastEdge.inv(), lastOri))
-        # create new paths with the valid extentions
-        extPaths = []
-        for n in ext:
-            new = copy.deepcopy(self)
-            new.extend(n[0], n[1], n[2])
-            extPaths.append(new)
-        return extPaths
-    
-    def extend(self, cube: Cube, edge: Direction, edgeOri: Direction):
-        self.__path.append((cube, edge, edgeOri))
-        self.__oriAvailable.difference_update([edgeOri.inv()])
+    @staticmethod
+    def __bits(mask: int):
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
 
 
 def twoCutSubassemblies(poly: Polyomino) -> dict:
-    twoCuts = {}
-    for cube in poly.getCubes():
-        for edge in Direction.list():
-            if poly.getConnectedAt(cube, edge) == None:
-                continue
-            ori = Direction((edge.value + 1) % 4)
-            for cut, cons in __monotonCutsFrom(poly, cube, edge, ori).items():
-                if not cut in twoCuts:
-                    twoCuts[cut] = cons
-                else:
-                    twoCuts[cut].update(cons)
-    return twoCuts
-
-def __monotonCutsFrom(poly: Polyomino, startCube: Cube, startEdge: Direction, startOri: Direction) -> dict:
-    twoCuts = {}
-    next = Queue()
-    next.put(MonotoneCuttingPath(poly, startCube, startEdge, startOri))
-    while not next.empty():
-        path: MonotoneCuttingPath = next.get()
-        extPaths = path.extendedPaths()
-        if len(extPaths) == 0:
-            cut = path.cutPoly()
-            if cut.polyCount() == 2:
-                if not cut in twoCuts:
-                    twoCuts[cut] = set([path.pickConnection()])
-                else:
-                    twoCuts[cut].add(path.pickConnection())
-        else:
-            for ep in extPaths:
-                next.put(ep)
-    return twoCuts
+    return MonotoneCuttingPaths(poly).twoCuts()
 
 
 class TwoCutSubassemblyEdge:
@@ -140,11 +198,12 @@ class TwoCutSubassemblyGraph:
                 if poly.isTrivial():
                     continue
                 # calculate possible twoCuts or take from dict if calculated before
-                if poly in poly_twoCuts:
-                    twoCuts = poly_twoCuts[poly]
+                polyType = poly.polyType()
+                if polyType in poly_twoCuts:
+                    twoCuts = poly_twoCuts[polyType]
                 else:
                     twoCuts = twoCutSubassemblies(poly)
-                    poly_twoCuts[poly] = twoCuts
+                    poly_twoCuts[polyType] = twoCuts
                 # list all polys and remove one of the current type 
                 polys = polyColl.getAll()
                 polys.remove(poly)
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from multiprocessing.pool import Pool
 from sim.rendering import Renderer
 import math
@@ -5,12 +6,16 @@ from pymunk.vec2d import Vec2d
 
 from com.motion import Idle, Rotation, PivotWalk
 from sim.simulation import Simulation
+from sim.ensemble import Ensemble
 from com.state import Configuration, Cube, Direction
 from plan.plan import *
 
 
 DEBUG = False
 PLAN_PARALLEL = True
+# simulate all plans in lockstep in one process instead of a process pool. Faster with fewer cpus than plans, but
+# the worlds of an ensemble don't match a single simulation exactly, so a plan may not replay, see Ensemble.
+PLAN_ENSEMBLE = False
 
 CRITICAL_DISTANCE = Cube.MAG_DISTANCE_MIN
 SLOWWALK_DISTANCE = CRITICAL_DISTANCE * 1.5
@@ -28,6 +33,72 @@ PWALK_ANG_BIG = PivotWalk.DEFAULT_PIVOT_ANG
 PWALK_ANG_SMALL = PWALK_ANG_BIG / 1.5
 PWALK_PORTION = 1/2
 
+FEASIBILITY_CACHE_SIZE = 4096
+
+
+class Feasibility:
+    """
+    The checks of a connection that only depend on the types of the two polyominoes and on the
+    local coordinates of cubeA and cubeB in them, not on where the polyominoes are.
+    """
+    __slots__ = ("connect", "valid", "cave", "slide")
+
+    def __init__(self, connect: bool, valid: bool, cave: bool, slide: frozenset):
+        # the polyominoes can be connected without overlapping
+        self.connect = connect
+        # the connected polyomino has no same type side connection, False if they cant be connected
+        self.valid = valid
+        # one of the connecting edges is inside a hole
+        self.cave = cave
+        # the directions from which the polyominoes can slide together
+        self.slide = slide
+
+
+__feasibilityCache = OrderedDict()
+__feasibilityHits = 0
+__feasibilityMisses = 0
+
+
+def feasibility(config: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Direction) -> Feasibility:
+    """
+    Returns the feasibility of connecting cubeA to edgeB of cubeB. Verdicts are kept in a process wide
+    LRU cache of FEASIBILITY_CACHE_SIZE entries, see feasibilityCacheInfo.
+    """
+    global __feasibilityHits, __feasibilityMisses
+    polyA = config.getPolyominoes().getForCube(cubeA)
+    polyB = config.getPolyominoes().getForCube(cubeB)
+    key = (polyA.polyType(), polyA.getLocalCoordinates(cubeA), polyB.polyType(), polyB.getLocalCoordinates(cubeB),
+           edgeB.value, polyA is polyB)
+    verdict = __feasibilityCache.get(key)
+    if verdict != None:
+        __feasibilityHits += 1
+        __feasibilityCache.move_to_end(key)
+        return verdict
+    __feasibilityMisses += 1
+    targetPoly = polyA.connectPoly(cubeA, polyB, cubeB, edgeB)
+    slide = frozenset(d for d in (Direction.EAST, Direction.WEST)
+                      if polyA.connectPolyPossible(cubeA, polyB, cubeB, edgeB, d))
+    cave = __edgeInCave(polyA, cubeA, edgeB.inv()) or __edgeInCave(polyB, cubeB, edgeB)
+    verdict = Feasibility(targetPoly != None, targetPoly != None and targetPoly.isValid(), cave, slide)
+    __feasibilityCache[key] = verdict
+    if len(__feasibilityCache) > FEASIBILITY_CACHE_SIZE:
+        __feasibilityCache.popitem(last=False)
+    return verdict
+
+def feasibilityCacheInfo() -> tuple:
+    """
+    Returns hits, misses, hit rate and size of the feasibility cache of this process.
+    """
+    total = __feasibilityHits + __feasibilityMisses
+    return __feasibilityHits, __feasibilityMisses, __feasibilityHits / total if total > 0 else 0, len(__feasibilityCache)
+
+def clearFeasibilityCache():
+    global __feasibilityHits, __feasibilityMisses
+    __feasibilityCache.clear()
+    __feasibilityHits = 0
+    __feasibilityMisses = 0
+
+
 
 def planCubeConnect(initial: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Direction, allowedPolyColls: set=None) -> LocalPlan:
     # single update if no poly info available
@@ -50,7 +121,7 @@ def planCubeConnect(initial: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Dir
     if not __connectPossible(initial, cubeA, cubeB, edgeB):
         return LocalPlan(connection, initial, state=PlanState.FAILURE_CONNECT)
     # pre-check if connection edges are inside a hole
-    if __edgeInCave(initial, cubeA, edgeB.inv()) or __edgeInCave(initial, cubeB, edgeB):
+    if feasibility(initial, cubeA, cubeB, edgeB).cave:
         return LocalPlan(connection, initial, state=PlanState.FAILURE_CAVE)
     # pre check if polys can slide together from either east or west
     slideDirections = __slideInDirections(initial, cubeA, cubeB, edgeB)
@@ -68,6 +139,8 @@ def planCubeConnect(initial: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Dir
         plansToExec.append((initial, connection, PivotWalk.RIGHT, facingInv, allowedPolyColls))
     if DEBUG or not PLAN_PARALLEL:
         return __planSequential(plansToExec)
+    elif PLAN_ENSEMBLE:
+        return __planEnsemble(plansToExec)
     else:
         return __planParallel(plansToExec)
     
@@ -100,7 +173,43 @@ def __planSequential(data) -> LocalPlan:
             optPlan = optPlan.compare(plan)
     return optPlan
         
+def __planEnsemble(data) -> LocalPlan:
+    ensemble = Ensemble()
+    plans = ensemble.run([item[0] for item in data], [__alignWalkRealignProgram(item) for item in data],
+                         lambda plan: plan.state == PlanState.SUCCESS)
+    optPlan = None
+    for i, plan in enumerate(plans):
+        if plan == None:
+            continue
+        if DEBUG: print(f"{i+1} finished: {plan}")
+        if plan.state == PlanState.SUCCESS:
+            return plan
+        if optPlan == None:
+            optPlan = plan
+        else:
+            optPlan = optPlan.compare(plan)
+    return optPlan
+
 def __alignWalkRealign(data: tuple) -> LocalPlan:
+    # execute the program in its own simulation
+    sim = Simulation(DEBUG, False)
+    sim.loadConfig(data[0])
+    sim.renderer.markedCubes.add(data[1].cubeA)
+    sim.renderer.markedCubes.add(data[1].cubeB)
+    program = __alignWalkRealignProgram(data, sim.renderer)
+    try:
+        motions = next(program)
+        while True:
+            sim.executeMotions(motions)
+            motions = program.send(sim.saveConfig())
+    except StopIteration as stop:
+        plan = stop.value
+    # terminate sim and return plan with last state sim was in as goal
+    plan.goal = sim.terminate()
+    return plan
+
+def __alignWalkRealignProgram(data: tuple, renderer: Renderer=None):
+    # yields the motions to execute and receives the configuration afterwards, returns the plan
     # unpack data
     config: Configuration = data[0]
     con: Connection = data[1]
@@ -110,12 +219,8 @@ def __alignWalkRealign(data: tuple) -> LocalPlan:
     direction = data[2]
     slide: Direction = data[3]
     allowed: set = data[4]
-    # init plan and simulation
+    # init plan
     plan = LocalPlan(con, config)
-    sim = Simulation(DEBUG, False)
-    sim.loadConfig(config)
-    sim.renderer.markedCubes.add(cubeA)
-    sim.renderer.markedCubes.add(cubeB)
     # init varables
     MAX_MOVING_DIST = 2 * (config.boardSize[0] + config.boardSize[1])
     if DEBUG: print(f"Max walking distance: {MAX_MOVING_DIST}")
@@ -126,10 +231,9 @@ def __alignWalkRealign(data: tuple) -> LocalPlan:
     while True:
         # aligne the cubes.
         rotation = __alignCubes(config, cubeA, cubeB, edgeB, slide)
-        sim.executeMotion(rotation)
+        config = yield [rotation]
         if DEBUG: print(rotation)
         plan.actions.append(rotation)
-        config = sim.saveConfig()
         # update the planstate. Check failure and success conditions
         plan.state = __updatePlanState(config, cubeA, cubeB, edgeB, slide, allowed)
         if plan.state != PlanState.UNDEFINED:
@@ -139,26 +243,25 @@ def __alignWalkRealign(data: tuple) -> LocalPlan:
         if distAB < CRITICAL_DISTANCE and wait:
             # if in critical distance wait short time
             idle = Idle(IDLE_AMOUNT)
-            sim.executeMotion(idle)
+            config = yield [idle]
             if DEBUG: print(idle)
             plan.actions.append(idle)
-            config = sim.saveConfig()
             wait = False
         else:
             # if not walk into direction
             pA0 = config.getPosition(cubeA)
             pB0 = config.getPosition(cubeB)
             pWalks = __walkDynamic(config, cubeA, cubeB, direction)
-            sim.executeMotions(pWalks)
+            config = yield pWalks
             if DEBUG: print(f"{len(pWalks)} x {pWalks[0]}")
             plan.actions.extend(pWalks)
-            config = sim.saveConfig()
             # determine how distance changes after pivot walking
             distChangeA = config.getPosition(cubeA).get_distance(pA0)
             distChangeB = config.getPosition(cubeB).get_distance(pB0)
             distMoved += distChangeA + distChangeB
-            sim.renderer.linesToDraw.append((Renderer.RED, pA0, config.getPosition(cubeA), 3))
-            sim.renderer.linesToDraw.append((Renderer.BLUE, pB0, config.getPosition(cubeB), 3))
+            if renderer != None:
+                renderer.linesToDraw.append((Renderer.RED, pA0, config.getPosition(cubeA), 3))
+                renderer.linesToDraw.append((Renderer.BLUE, pB0, config.getPosition(cubeB), 3))
             # if both A and B did not move increase stuck
             if distChangeA < STUCK_OFFSET and distChangeB < STUCK_OFFSET:
                 stuckTimes += 1
@@ -169,18 +272,16 @@ def __alignWalkRealign(data: tuple) -> LocalPlan:
         if stuckTimes >= STUCK_TIMES_MAX:
             # force a straight align
             rotation = __alignCubes(config, cubeA, cubeB, edgeB, slide, True)
-            sim.executeMotion(rotation)
+            config = yield [rotation]
             if DEBUG: print(rotation)
             plan.actions.append(rotation)
-            config = sim.saveConfig()
             # wait as long as their positions change
             distAB = config.getPosition(cubeA).get_distance(config.getPosition(cubeB))
             while True:
                 idle = Idle(IDLE_STUCK_AMOUNT)
-                sim.executeMotion(idle)
+                config = yield [idle]
                 if DEBUG: print(f"{idle} because stuck.")
                 plan.actions.append(idle)
-                config = sim.saveConfig()
                 newDistAB = config.getPosition(cubeA).get_distance(config.getPosition(cubeB))
                 if distAB - newDistAB < STUCK_OFFSET / 2:
                     break
@@ -199,8 +300,7 @@ def __alignWalkRealign(data: tuple) -> LocalPlan:
             break
         if DEBUG: print(f"Itr: {itr}, {stuckTimes} times stuck, {distMoved} dist moved.")
         itr += 1
-    # terminate sim and return plan with last state sim was in as goal
-    plan.goal = sim.terminate()
+    plan.goal = config
     return plan
 
 def __alignCubes(config: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Direction, slide:Direction, forceStraight: bool=False):
@@ -278,7 +378,7 @@ def __updatePlanState(config: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Di
     if not __connectPossible(config, cubeA, cubeB, edgeB):
         return PlanState.FAILURE_CONNECT
     # check if connection edges are inside a hole
-    if __edgeInCave(config, cubeA, edgeB.inv()) or __edgeInCave(config, cubeB, edgeB):
+    if feasibility(config, cubeA, cubeB, edgeB).cave:
         return PlanState.FAILURE_CAVE
     # check if we cant slide in anymore
     if not slide in __slideInDirections(config, cubeA, cubeB, edgeB):
@@ -290,27 +390,15 @@ def __isConnected(config: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Direct
     return polyB.getConnectedAt(cubeB, edgeB) == cubeA
 
 def __connectPossible(config: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Direction) -> bool:
-    polyA = config.getPolyominoes().getForCube(cubeA)
-    polyB = config.getPolyominoes().getForCube(cubeB)
-    # poly resulting from connection would overlap, or cubes are inside the same polyomino
-    targetPoly = polyA.connectPoly(cubeA, polyB, cubeB, edgeB)
-    if targetPoly == None or not targetPoly.isValid():
-        return False
-    return True
+    # poly resulting from connection would overlap or be invalid, or cubes are inside the same polyomino
+    verdict = feasibility(config, cubeA, cubeB, edgeB)
+    return verdict.connect and verdict.valid
 
 def __slideInDirections(config: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Direction) -> set:
     # check if poly can be connected by walking in form the east and west
-    slide = set()
-    polyA = config.getPolyominoes().getForCube(cubeA)
-    polyB = config.getPolyominoes().getForCube(cubeB)
-    if polyA.connectPolyPossible(cubeA, polyB, cubeB, edgeB, Direction.EAST):
-        slide.add(Direction.EAST)
-    if polyA.connectPolyPossible(cubeA, polyB, cubeB, edgeB, Direction.WEST):
-        slide.add(Direction.WEST)
-    return slide
-
-def __edgeInCave(config: Configuration, cube: Cube, edge: Direction) -> bool:
-    poly = config.getPolyominoes().getForCube(cube)
+    return feasibility(config, cubeA, cubeB, edgeB).slide
+
+def __edgeInCave(poly, cube: Cube, edge: Direction) -> bool:
     coords = poly.getLocalCoordinates(cube)
     if edge == Direction.NORTH:
         coordsToCheck = ((coords[0] + 1, coords[1] + 1),(coords[0] - 1, coords[1] + 1))
@@ -330,12 +418,8 @@ def __polysAllowed(config: Configuration, allowed: set) -> bool:
 def __polysInvalid(config: Configuration, cubeA: Cube, cubeB: Cube, edgeB: Direction) -> bool:
     if config.getPolyominoes().containsInvalid():
         return True
-    polyA = config.getPolyominoes().getForCube(cubeA)
-    polyB = config.getPolyominoes().getForCube(cubeB)
-    targetPoly = polyA.connectPoly(cubeA, polyB, cubeB, edgeB)
-    if targetPoly != None and not targetPoly.isValid():
-        return True
-    return False
+    verdict = feasibility(config, cubeA, cubeB, edgeB)
+    return verdict.connect and not verdict.valid
 
 def __faceingDirection(config: Configuration, cubeA: Cube, cubeB: Cube) -> Direction:
     """
@@ -0,0 +1,148 @@
+"""
+Holds the Ensemble class
+
+@author: Aaron T Becker, Kjell Keune
+"""
+import time
+import numpy as np
+
+from com.state import Configuration, Cube
+from sim.handling import StateHandler
+from sim.simulation import Simulation
+
+
+class Ensemble:
+    """
+    Simulates many independent configurations in lockstep. All configurations are loaded as worlds
+    of one StateHandler, so every update steps one pymunk space and calculates the magnet, field and
+    friction forces of all worlds at once. Each world gets its own copies of the cubes, so the same
+    configuration can be simulated multiple times.
+    The worlds are not bit-identical to single simulations: pymunk solves the contacts of all worlds in one
+    pass, in an order that depends on every shape in the space. A world deviates from its single simulation
+    like one with the cubes added in a different order, a few px after some motions.
+    """
+
+    def __init__(self, neighborList=False, compoundBodies=False, sleeping=False):
+        """
+        Parameters:
+            neighborList: if magnet pairs are found with a neighbor list instead of pymunk sensor collisions
+            compoundBodies: if the cubes of each polyomino are simulated as one rigid body
+            sleeping: if resting cubes fall asleep, so worlds whose programs returned cost almost nothing
+        """
+        self.stateHandler = StateHandler(neighborList, compoundBodies, sleeping=sleeping)
+        self.update = 0
+        self.__cube_copy = []
+        self.__copy_cube = []
+
+    def loadConfigs(self, configs: list):
+        """
+        Loads the configurations, one world for each.
+        """
+        self.__cube_copy = [{cube: Cube(cube.type) for cube in config.getCubes()} for config in configs]
+        self.__copy_cube = [{copy: cube for cube, copy in cube_copy.items()} for cube_copy in self.__cube_copy]
+        self.stateHandler.loadConfigs([Ensemble.__mapConfig(config, cube_copy)
+                                       for config, cube_copy in zip(configs, self.__cube_copy)])
+
+    def saveConfig(self, world: int) -> Configuration:
+        """
+        Returns the configuration the world currently has, with the cubes of the loaded configuration.
+        """
+        return Ensemble.__mapConfig(self.stateHandler.saveConfig(world), self.__copy_cube[world])
+
+    def executeMotions(self, motions: list) -> list:
+        """
+        Simulates a list of motions in each world, all worlds are updated in lockstep.
+
+        Parameters:
+            motions: one list of motions for each world
+
+        Returns:
+            the configuration of each world right after its motions finished executing
+        """
+        def program(worldMotions):
+            config = yield worldMotions
+            return config
+        return self.run(None, [program(worldMotions) for worldMotions in motions])
+
+    def run(self, configs: list, programs: list, stop=None) -> list:
+        """
+        Runs one program for each configuration in lockstep. A program is a generator that yields lists of motions
+        and receives the configuration of its world after they got executed. The worlds of programs that
+        returned are still simulated, but their magnetic field does not change anymore.
+
+        Parameters:
+            configs: the configurations to load, None to continue with the current worlds
+            programs: one program for each world
+            stop: called with the return value of each program that returned, if it returns True
+                the remaining programs are closed and the run ends
+
+        Returns:
+            the return values of the programs, None for the programs that were closed
+        """
+        tt = time.time()
+        if configs != None:
+            self.loadConfigs(configs)
+        n = len(programs)
+        results = [None] * n
+        angChanges = [None] * n
+        elevations = [None] * n
+        cursors = [0] * n
+        active = []
+        stopped = False
+        for world, program in enumerate(programs):
+            if self.__advance(world, program, True, angChanges, elevations, results):
+                active.append(world)
+            elif stop != None and stop(results[world]):
+                stopped = True
+                break
+        stepAng = np.zeros(n)
+        stepElev = np.zeros(n, dtype=int)
+        while len(active) > 0 and not stopped:
+            for world in active:
+                stepAng[world] = angChanges[world][cursors[world]]
+                stepElev[world] = elevations[world][cursors[world]]
+            self.stateHandler.update(stepAng, stepElev, Simulation.STEP_TIME)
+            self.update += 1
+            stepAng[:] = 0
+            stepElev[:] = 0
+            for world in list(active):
+                cursors[world] += 1
+                if cursors[world] < len(angChanges[world]):
+                    continue
+                cursors[world] = 0
+                if not self.__advance(world, programs[world], False, angChanges, elevations, results):
+                    active.remove(world)
+                    if stop != None and stop(results[world]):
+                        stopped = True
+                        break
+        for program in programs:
+            program.close()
+        self.stateHandler.timer.addToTotal(time.time() - tt)
+        return results
+
+    def __advance(self, world, program, start, angChanges, elevations, results) -> bool:
+        # hand the configuration of the world to the program and compile its next motions, False if it returned
+        try:
+            config = self.saveConfig(world)
+            motions = next(program) if start else program.send(config)
+            while True:
+                polys = config.getPolyominoes()
+                longestChain = max(polys.maxWidth, polys.maxHeight)
+                steps = [motion.stepArray(Simulation.STEP_TIME, longestChain) for motion in motions]
+                if sum(len(s) for s in steps) > 0:
+                    steps = np.concatenate(steps)
+                    angChanges[world] = steps[:, 0].tolist()
+                    elevations[world] = steps[:, 1].astype(int).tolist()
+                    return True
+                motions = program.send(config)
+        except StopIteration as stop:
+            results[world] = stop.value
+            return False
+
+    @staticmethod
+    def __mapConfig(config: Configuration, cube_map: dict) -> Configuration:
+        # the same configuration with every cube replaced by cube_map[cube], the arrays are shared
+        cubes, pos, ang, vel = config.getArrays()
+        polys = [poly.mapCubes(cube_map) for poly in config.getPolyominoes().getAll()]
+        return Configuration.fromArrays(config.boardSize, config.magAngle, [cube_map[cube] for cube in cubes], pos, ang, vel,
+                                        polys, config.magElevation)
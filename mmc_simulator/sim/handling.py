@@ -7,6 +7,7 @@ Holds the StateHandler class
 import time
 import json
 import os
+import numpy as np
 import pymunk
 from pymunk.vec2d import Vec2d
 import math
@@ -60,40 +61,158 @@ class StateHandler:
     NOMINAL_FRICTION = 0.35
     FRICTION_DAMPING = 0.9
     ANG_VEL_DAMP = 0.85
+    ANG_VEL_DAMP_TIME = 0.07  # time step ANG_VEL_DAMP is given for
 
     SENSOR_CTYPE = 1
+    NEIGHBOR_SKIN = Cube.RAD  # extra distance of the neighbor list, it is rebuilt when a cube moved more than half of it
+    ISOLATION_SKIN = 2 * Cube.RAD  # extra distance for isolated bodies in multi rate mode, checked when a cube moved a quarter of it
+    # velocities (px/s and rad/s) below which a cube counts as resting and how many updates an island has to rest to fall asleep,
+    # cubes that slowly creep towards each other are much faster than this
+    SLEEP_VELOCITY = 0.01
+    SLEEP_ANG_VELOCITY = 0.001
+    SLEEP_UPDATES = 10
+    WAKE_DISTANCE = Cube.MAG_DISTANCE_MIN + Cube.RAD  # cubes closer than this are in the same island, see sleeping
+    FUSE_DELAY = 10  # updates the cubes of a compound body that got overloaded stay single bodies before they are fused again
     BOUNDARIE_RAD = 8
+    WORLD_GAP = 2 * Cube.MAG_DISTANCE_MIN  # space between the boards of the worlds loaded with loadConfigs
     DEFAULT_BOARDSIZE = (800,800)
     DEFAULT_CONFIG = Configuration(DEFAULT_BOARDSIZE, math.radians(90), {})
 
-    def __init__(self):
+    MAGNET_POS = np.array(Cube.MAGNET_POS, dtype=float)
+    MAGNET_ORI = np.array([Cube.MAGNET_ORI[Cube.TYPE_RED], Cube.MAGNET_ORI[Cube.TYPE_BLUE]], dtype=float)  # indexed by type
+    # the magnet of a cube nearest to a point, indexed by the octant of the point in the frame of the cube:
+    # 4 * (|x| >= |y|) + 2 * (x < 0) + (y < 0)
+    NEAREST_MAGNET = np.array([3, 1, 3, 1, 2, 2, 0, 0])
+
+    def __init__(self, neighborList=False, compoundBodies=False, multiRate=False, sleeping=False):
+        """
+        Parameters:
+            neighborList: if True, magnet pairs are taken from a neighbor list instead of sensor collisions in pymunk
+            compoundBodies: if True, the cubes of a polyomino are fused into one rigid body. This is an approximation.
+                A fused body only splits into single cubes when the load on one of its connections exceeds what
+                the magnets hold, see __overloaded, and it doesn't flex before that like connected single cubes.
+                Assemblies can end in other polyominoes than without it, a letter C breaks into [3, 4, 4]
+                instead of [1, 3, 3, 4] in a half turn and random boards lose fewer connections.
+            multiRate: if True, bodies without other cubes or walls in range leave the pymunk space and are
+                integrated without collisions and magnets until something gets in range again
+            sleeping: if True, islands of cubes closer than WAKE_DISTANCE to each other fall asleep when all their
+                cubes rest and their net magnet, field and friction force is too small to move them. Sleeping
+                bodies leave the pymunk space and keep their magnetic connections. An island wakes up when
+                the field of its world changes or an awake cube comes closer than WAKE_DISTANCE.
+        """
         self.space: pymunk.Space = None
+        self.neighborList = neighborList
+        self.compoundBodies = compoundBodies
+        self.multiRate = multiRate
+        self.sleeping = sleeping
 
-        self.magAngle = 0
-        self.magElevation = 0
+        # orientation and elevation of the magnetic field for each world, see loadConfigs
+        self.magAngles = np.zeros(1)
+        self.magElevations = np.zeros(1, dtype=int)
         self.boardSize = StateHandler.DEFAULT_BOARDSIZE
+        self.__boardSizes = [StateHandler.DEFAULT_BOARDSIZE]
+        self.__worldOffset = np.zeros((1, 2))
+        self.__cubeWorld = np.zeros(0, dtype=int)
 
         self.bounds = []
         self.cube_shapes = {}
         self.sensor_cube = {}
-        self.cube_force = {}
+        self.cube_index = {}
+        self.index_cube = []
+        self.cube_bodies = []
+        self.magnetOri = np.zeros((0, 4, 2))
+        self.cubeMass = np.zeros(0)
+        self.cubePos = np.zeros((0, 2))
+        self.cubeAng = np.zeros(0)
+        # bodies can hold multiple cubes, the pose of a cube is given relative to its body
+        self.__bodies = []
+        self.__bodyIndex = np.zeros(0, dtype=int)
+        self.__bodyAng = np.zeros(0)
+        self.__bodyCubes = {}
+        self.__cubeOffset = np.zeros((0, 2))
+        self.__cubeAngOffset = np.zeros(0)
+        self.__cogOffset = np.zeros((0, 2))
+        self.__fusedConnect = np.full((0, 4), -1)
+        self.__fusedCount = 0
+        self.__fuseCountdown = np.zeros(0, dtype=int)
+        self.__cuts = None
+        self.__cubeMoment = np.zeros(0)
+        self.__fieldForce = None
+        self.__fieldTorque = None
+        self.__gathered = False
+        self.__maxVelocity = 0
+        self.__maxAngVelocity = 0
+        self.__bodySpeed = np.zeros(0)
+        self.__speedingUp = False
+        self.__elevation_friction = {}
+        self.__fricPoints = np.zeros((0, 2))
+        self.__fricDrawn = np.zeros(0, dtype=bool)
+        # state of the bodies that left the space in multi rate mode, one row per body
+        self.__offline = np.zeros(0, dtype=bool)
+        self.__offPos = np.zeros((0, 2))
+        self.__offAng = np.zeros(0)
+        self.__offVel = np.zeros((0, 2))
+        self.__offAngVel = np.zeros(0)
+        self.__offForce = np.zeros((0, 2))
+        self.__offTorque = np.zeros(0)
+        self.__offCog = np.zeros((0, 2))
+        self.__offMass = np.zeros(0)
+        self.__offMoment = np.zeros(0)
+        self.__offSynced = True
+        self.__isolationPos = None
+        self.__onlineIdx = np.zeros(0, dtype=int)
+        self.__onlineBodies = []
+        # sleeping bodies are offline too, but they don't get integrated. The island of a sleeping body is
+        # the index of the first cube of the island, the rest count is kept for every cube
+        self.__asleep = np.zeros(0, dtype=bool)
+        self.__sleepIsland = np.zeros(0, dtype=int)
+        self.__restCount = np.zeros(0, dtype=int)
+        self.__wakePos = None
+        self.__wakeClearance = np.zeros(0)
+        self.__magnetForce = None
+        self.__magnetTorque = None
 
         self.criticalCubePairs = []
-        self.magConnect = {}
-        self.magConnect_pre = {}
+        self.__neighborPairs = np.zeros((2, 0), dtype=int)
+        self.__neighborPos = None
+        # magnetic connections as indices of the connected cube for each edge, -1 if not connected
+        self.magConnect = np.full((0, 4), -1)
+        self.magConnect_pre = np.full((0, 4), -1)
+        self.__connectCount = 0
+        self.__connectCount_pre = 0
+        self.__connectChanged = False
+        self.__undetected = set()
         self.polyominoes = PolyCollection() 
 
         self.timer = Timer()
-        self.frictionpoints = {}
 
         self.loadConfig(StateHandler.DEFAULT_CONFIG)
         # JOINTS
         # self.connectJoints = []
 
+    @property
+    def magAngle(self):
+        return float(self.magAngles[0])
+
+    @magAngle.setter
+    def magAngle(self, value):
+        self.magAngles[0] = value
+
+    @property
+    def magElevation(self):
+        return int(self.magElevations[0])
+
+    @magElevation.setter
+    def magElevation(self, value):
+        self.magElevations[0] = value
+
     def getCubeShape(self, cube: Cube):
         return self.cube_shapes[cube][0]
 
     def getSensorShape(self, cube: Cube):
+        """
+        Returns the sensor shape of the cube, None if the neighbor list is used.
+        """
         return self.cube_shapes[cube][1]
 
     def getCubes(self):
@@ -102,33 +221,103 @@ class StateHandler:
     def getBoundaries(self):
         return self.bounds
 
+    def getCubePose(self, cube: Cube):
+        """
+        Returns position and angle of the cube. Use this instead of the body of the cube shape,
+        because cubes might share one body.
+        """
+        if not self.__offSynced:
+            self.__syncOffline()
+        n = self.cube_index[cube]
+        body = self.cube_bodies[n]
+        offset = self.__cubeOffset[n]
+        return body.local_to_world((offset[0], offset[1])), body.angle + self.__cubeAngOffset[n]
+
     def loadConfig(self, newConfig: Configuration):
+        """
+        Loads the configuration. If the space already contains cubes, the bodies of the cubes that are
+        part of the new configuration are reused, the result is the same as loading into a new StateHandler.
+        """
+        self.loadConfigs([newConfig])
+
+    def loadConfigs(self, configs: list):
+        """
+        Loads the configurations side by side into the same space, each one as its own world with its
+        own magnetic field. The boards are WORLD_GAP apart, so cubes of different worlds never interact,
+        and all worlds are simulated in lockstep by one update. The configurations must not share cubes.
+
+        Parameters:
+            configs: list of configurations, the index of a configuration is the index of its world
+        """
         t0 = time.time()
-        self.magAngle = newConfig.magAngle
-        self.magElevation = newConfig.magElevation
-        self.boardSize = newConfig.boardSize
-        self.polyominoes = PolyCollection(newConfig.getPolyominoes().getAll())
+        self.__wakeAll()
+        kept = {}
+        if len(self.cube_shapes) > 0:
+            kept = self.__keepCubes(set(cube for config in configs for cube in config.getCubes()))
+        boardSizes = [config.boardSize for config in configs]
+        self.magAngles = np.array([config.magAngle for config in configs], dtype=float)
+        self.magElevations = np.array([config.magElevation for config in configs], dtype=int)
+        self.boardSize = boardSizes[0]
+        self.__boardSizes = boardSizes
+        # the worlds are placed next to each other along the x-axis
+        widths = [0] + [size[0] + StateHandler.WORLD_GAP for size in boardSizes[:-1]]
+        self.__worldOffset = np.stack((np.cumsum(widths), np.zeros(len(configs))), axis=-1).astype(float)
+        self.polyominoes = PolyCollection([poly for config in configs for poly in config.getPolyominoes().getAll()])
         # JOINTS
         # self.__removeConnectJoints__()
-        # clear space
+        # clear space, the kept bodies are added to the new one like new bodies, so the load doesn't depend on what
+        # the space held before
         self.__resetSpace()
-        # add new objects to space
         self.__addBoundaries()
-        for cube in newConfig.getCubes():
-            pos = newConfig.getPosition(cube)
-            ang = newConfig.getAngle(cube)
-            vel = newConfig.getVelocity(cube)
-            self.__addCube(cube, pos, ang, vel)
+        # add new objects to space
+        worlds = []
+        for world, config in enumerate(configs):
+            offset = Vec2d(*self.__worldOffset[world])
+            for cube in config.getCubes():
+                pos = config.getPosition(cube) + offset
+                ang = config.getAngle(cube)
+                vel = config.getVelocity(cube)
+                self.__addCube(cube, pos, ang, vel, kept.get(cube))
+                worlds.append(world)
+        self.__allocateArrays()
+        self.__cubeWorld = np.array(worlds, dtype=int)
+        self.__resetOffline()
+        # the loaded polyominoes define the previous magnetic connections
+        for cube, n in self.cube_index.items():
+            if not cube in self.polyominoes.cube_poly:
+                self.__undetected.add(cube)
+                continue
+            for edge, adj in enumerate(self.polyominoes.getForCube(cube).getConnected(cube)):
+                if adj != None and adj in self.cube_index:
+                    self.magConnect_pre[n, edge] = self.cube_index[adj]
+        self.__connectCount_pre = np.count_nonzero(self.magConnect_pre >= 0)
+        if self.compoundBodies:
+            self.__updateBodies(self.polyominoes.cube_poly.keys())
+            self.__resetOffline()
+            self.magConnect[:] = self.__fusedConnect
+            self.__connectCount = self.__fusedCount
         self.timer.addToTask("Load Configuration", time.time() - t0)
 
-    def saveConfig(self) -> Configuration:
+    def saveConfig(self, world=0) -> Configuration:
+        """
+        Returns the configuration of the world, see loadConfigs. There is only world 0 after loadConfig.
+        """
         t0 = time.time()
-        cube_pos = {}
-        cube_meta = {}
-        for cube, shapes in self.cube_shapes.items():
-            cube_pos[cube] = shapes[0].body.position
-            cube_meta[cube] = (shapes[0].body.angle, shapes[0].body.velocity)
-        config = Configuration(self.boardSize, self.magAngle, cube_pos, cube_meta, self.polyominoes.getAll(), self.magElevation)
+        self.__gatherPositions()
+        _, _, vel, _ = self.__readVelocities()
+        offset = self.__worldOffset[world]
+        polys = self.polyominoes.getAll()
+        if len(self.__boardSizes) == 1:
+            # the cube list and index are replaced when cubes get loaded, so the configuration can share them
+            cubes, cube_index = self.index_cube, self.cube_index
+            pos, ang = self.cubePos - offset, self.cubeAng.copy()
+        else:
+            idx = np.nonzero(self.__cubeWorld == world)[0]
+            cubes, cube_index = [self.index_cube[n] for n in idx], None
+            pos, ang, vel = self.cubePos[idx] - offset, self.cubeAng[idx], vel[idx]
+            polys = [poly for poly in polys if self.__cubeWorld[self.cube_index[poly.getRoot()]] == world]
+        config = Configuration.fromArrays(self.__boardSizes[world], float(self.magAngles[world]), cubes, pos, ang, vel,
+                                          polys, int(self.magElevations[world]), cube_index)
         self.timer.addToTask("Save Configuration", time.time() - t0)
         return config
 
@@ -141,185 +330,630 @@ class StateHandler:
             angChange: angular change (in radians)
             elevChange: elevation change
         """
-        # let pymunk update the space this also creates the magnetic connections
+        if self.sleeping:
+            self.__wakeIslands(angChange, elevation)
+        if len(self.__bodyCubes) > 0:
+            # the load on the fused connections follows from the change of the velocities in the step
+            self.__gatherPositions()
+            bodyVel, bodyAngVel, _, _ = self.__readVelocities()
+        if self.multiRate:
+            self.__multiRate(dt)
+        # let pymunk update the space this also applies the magnet forces and creates the magnetic connections
         t0 = time.time()
+        self.__gathered = False
+        self.__magnetForce = None
+        self.__magnetTorque = None
         self.space.step(dt)
         self.timer.addToTask("Pymunk-Step", time.time() - t0)
-        # apply the change
-        self.magAngle += angChange
-        if elevation != 0:
-            self.magElevation = elevation
-        # apply magnet forces for cubes in critical-distance
-        t0 = time.time()
-        for cubei, cubej in self.criticalCubePairs:
-            self.__applyForceMagnets(cubei, cubej)
-        self.timer.addToTask("Force Calculation", time.time() - t0)
-        self.criticalCubePairs.clear()
+        if len(self.__bodyCubes) > 0:
+            self.__dissolveOverloaded(bodyVel, bodyAngVel, dt)
+        # apply the change, angChange and elevation are arrays with one entry per world after loadConfigs
+        self.magAngles += angChange
+        np.copyto(self.magElevations, elevation, where=np.not_equal(elevation, 0))
         # detect polyominos based on the magnetic connections
         t0 = time.time()
-        if not self.magConnect == self.magConnect_pre:
-            self.polyominoes.detectPolyominoes(self.magConnect)
+        if self.__connectChanged or self.__connectCount != self.__connectCount_pre or len(self.__undetected) > 0:
+            changed = set(self.__undetected)
+            for n in np.nonzero((self.magConnect != self.magConnect_pre).any(axis=1))[0]:
+                changed.add(self.index_cube[n])
+            self.polyominoes.updatePolyominoes(self.__connectionMap(changed), changed)
+            self.__undetected.clear()
+            self.__elevation_friction.clear()
+            if self.compoundBodies:
+                self.__wakeAll()
+                self.__updateBodies(changed)
+                self.__resetOffline()
+        if self.__fuseCountdown.any():
+            self.__fuseAgain()
         self.timer.addToTask("Polyomino Detection", time.time() - t0)
-        # safe magnetic connections to _pre and clear this one
-        self.magConnect_pre = self.magConnect
-        self.magConnect = {}
-        # apply forces from magneticfield to each cube in each poly
-        self.frictionpoints.clear()
+        # safe magnetic connections to _pre and clear this one, connections inside compound bodies are kept
+        self.magConnect_pre, self.magConnect = self.magConnect, self.magConnect_pre
+        self.magConnect[:] = self.__fusedConnect
+        self.__connectCount_pre = self.__connectCount
+        self.__connectCount = self.__fusedCount
+        self.__connectChanged = False
+        if self.__asleep.any():
+            self.__keepSleepingConnections()
+        # apply forces from magneticfield and friction to all cubes at once
+        self.__applyForceFieldFriction()
+
+    def __connectionMap(self, cubes) -> dict:
+        # connection map of the given cubes and all cubes reachable from them, old and new polyominoes
+        connects = {}
+        next = list(cubes)
+        while len(next) > 0:
+            cube = next.pop()
+            if cube in connects:
+                continue
+            n = self.cube_index[cube]
+            connects[cube] = [self.index_cube[k] if k >= 0 else None for k in self.magConnect[n]]
+            next.extend(adj for adj in connects[cube] if adj != None)
+            if cube in self.polyominoes.cube_poly:
+                next.extend(self.polyominoes.getForCube(cube).getCubes())
+        return connects
+
+    def isResting(self, maxVelocity, maxAngVelocity) -> bool:
+        """
+        Returns True if no cube was faster than maxVelocity and maxAngVelocity after the last update and the
+        cubes did not speed up. Cubes that get pulled together by their magnets speed up slowly.
+        """
+        return self.__maxVelocity < maxVelocity and self.__maxAngVelocity < maxAngVelocity and not self.__speedingUp
+
+    def getFrictionPoints(self) -> list:
+        """
+        Returns the points friction was applied at during the last update. Just for drawing.
+        """
+        return [Vec2d(p[0], p[1]) for p in self.__fricPoints[self.__fricDrawn]]
+
+    def __gatherPositions(self):
+        # read position and angle of all cube bodies once per step
+        if self.__gathered:
+            return
+        if self.__offline.any():
+            bodyPos = self.__readBodies(self.__offPos, [body.position for body in self.__onlineBodies])
+            self.__bodyAng = self.__readBodies(self.__offAng, [body.angle for body in self.__onlineBodies])
+        else:
+            bodyPos = np.array([body.position for body in self.__bodies], dtype=float).reshape((-1, 2))
+            self.__bodyAng = np.array([body.angle for body in self.__bodies], dtype=float)
+        if len(self.__bodyCubes) == 0:
+            self.cubePos = bodyPos
+            self.cubeAng = self.__bodyAng
+        else:
+            b = self.__bodyIndex
+            cos, sin = np.cos(self.__bodyAng)[b], np.sin(self.__bodyAng)[b]
+            self.cubePos = bodyPos[b] + StateHandler.__rotated(self.__cubeOffset, cos, sin)
+            self.cubeAng = self.__bodyAng[b] + self.__cubeAngOffset
+        self.__gathered = True
+
+    def __readBodies(self, offValues, onValues):
+        # values of all bodies, the bodies outside the space take them from offValues
+        values = offValues.copy()
+        if len(self.__onlineIdx) > 0:
+            values[self.__onlineIdx] = onValues
+        return values
+
+    def __multiRate(self, dt):
+        # move bodies between the space and the cheap integration below depending on their surroundings
         t0 = time.time()
-        for poly in self.polyominoes.getAll():
-            for cube in poly.getCubes():
-                self.__applyForceField(cube)
-                self.__applyForceFriction(cube, poly)
-                self.magConnect[cube] = [None] * 4
-                self.cube_force[cube] = Vec2d(0,0)
-        self.timer.addToTask("Force Calculation", time.time() - t0)
-
-    def __applyForceField(self, cube: Cube):
+        self.__gatherPositions()
+        # two cubes can't get closer than half of the skin before the next check
+        if self.__isolationPos is None or \
+            np.max(np.sum((self.cubePos - self.__isolationPos) ** 2, axis=1), initial=0) > (StateHandler.ISOLATION_SKIN / 4) ** 2:
+            isolated = self.__isolatedBodies()
+            for n in np.nonzero(isolated & ~self.__offline)[0]:
+                self.__takeOffline(n)
+            for n in np.nonzero(~isolated & self.__offline & ~self.__asleep)[0]:
+                self.__bringOnline(n)
+            self.__updateOnline()
+            self.__isolationPos = self.cubePos.copy()
+        # integrate like pymunk does without collisions and magnets, first the positions then the velocities
+        k = np.nonzero(self.__offline & ~self.__asleep)[0]
+        if len(k) > 0:
+            cog = self.__offPos[k] + StateHandler.__rotated(self.__offCog[k], np.cos(self.__offAng[k]), np.sin(self.__offAng[k]))
+            cog += self.__offVel[k] * dt
+            self.__offAng[k] += self.__offAngVel[k] * dt
+            self.__offPos[k] = cog - StateHandler.__rotated(self.__offCog[k], np.cos(self.__offAng[k]), np.sin(self.__offAng[k]))
+            self.__offVel[k] += self.__offForce[k] / self.__offMass[k][:, None] * dt
+            self.__offAngVel[k] += self.__offTorque[k] / self.__offMoment[k] * dt
+            self.__offForce[k] = 0
+            self.__offTorque[k] = 0
+            self.__offSynced = False
+        self.timer.addToTask("Multi Rate", time.time() - t0)
+
+    def __isolatedBodies(self):
+        # bodies without cubes of other bodies in magnet distance and without walls in contact distance,
+        # bodies that are already isolated stay so until they are half of the skin closer
+        pos = self.cubePos
+        b = self.__bodyIndex
+        diff = pos[:, None, :] - pos[None, :, :]
+        dist = np.sum(diff ** 2, axis=2)
+        dist[b[:, None] == b[None, :]] = np.inf
+        clearance = np.sqrt(np.min(dist, axis=1, initial=np.inf)) - Cube.MAG_DISTANCE_MIN
+        # distance to the walls of the world the cube is in
+        rel = pos - self.__worldOffset[self.__cubeWorld]
+        size = np.array(self.__boardSizes, dtype=float)[self.__cubeWorld]
+        wall = np.min(np.minimum(rel, size - rel), axis=1) - math.sqrt(2) * Cube.RAD - StateHandler.BOUNDARIE_RAD
+        bodyClearance = np.full(len(self.__bodies), np.inf)
+        np.minimum.at(bodyClearance, b, np.minimum(clearance, wall))
+        skin = np.where(self.__offline, StateHandler.ISOLATION_SKIN / 2, StateHandler.ISOLATION_SKIN)
+        return bodyClearance > skin
+
+    def __bodyShapes(self, n):
+        # shapes of the body in the same order as they are added everywhere else
+        shapes = []
+        for k in np.nonzero(self.__bodyIndex == n)[0]:
+            shape, magSensor = self.cube_shapes[self.index_cube[k]]
+            shapes.extend(s for s in (magSensor, shape) if s != None)
+        return shapes
+
+    def __takeOffline(self, n):
+        body = self.__bodies[n]
+        self.__offPos[n] = body.position
+        self.__offAng[n] = body.angle
+        self.__offVel[n] = body.velocity
+        self.__offAngVel[n] = body.angular_velocity
+        self.__offForce[n] = body.force
+        self.__offTorque[n] = body.torque
+        self.__offCog[n] = body.center_of_gravity
+        self.__offMass[n] = body.mass
+        self.__offMoment[n] = body.moment
+        self.space.remove(body, *self.__bodyShapes(n))
+        self.__offline[n] = True
+
+    def __bringOnline(self, n):
+        body = self.__bodies[n]
+        self.space.add(body, *self.__bodyShapes(n))
+        # adding shapes moves the center of gravity, so the state is set afterwards. The angle turns the body
+        # about its center of gravity, so it is set before the position.
+        body.angle = self.__offAng[n]
+        body.position = (self.__offPos[n, 0], self.__offPos[n, 1])
+        body.velocity = (self.__offVel[n, 0], self.__offVel[n, 1])
+        body.angular_velocity = self.__offAngVel[n]
+        body.force = (self.__offForce[n, 0], self.__offForce[n, 1])
+        body.torque = self.__offTorque[n]
+        self.__offline[n] = False
+
+    def __syncOffline(self):
+        # bodies outside the space are not updated by the integration, they get the current state when it is read
+        for n in np.nonzero(self.__offline)[0]:
+            body = self.__bodies[n]
+            body.position = (self.__offPos[n, 0], self.__offPos[n, 1])
+            body.angle = self.__offAng[n]
+            body.velocity = (self.__offVel[n, 0], self.__offVel[n, 1])
+            body.angular_velocity = self.__offAngVel[n]
+        self.__offSynced = True
+
+    def __updateOnline(self):
+        self.__onlineIdx = np.nonzero(~self.__offline)[0]
+        self.__onlineBodies = [self.__bodies[n] for n in self.__onlineIdx]
+
+    def __wakeAll(self):
+        # bring all bodies back into the space, needed before bodies get replaced
+        for n in np.nonzero(self.__offline)[0]:
+            self.__bringOnline(n)
+        self.__asleep[:] = False
+        self.__offSynced = True
+
+    def __resetOffline(self):
+        # all bodies are in the space
+        b = len(self.__bodies)
+        self.__offline = np.zeros(b, dtype=bool)
+        self.__offPos = np.zeros((b, 2))
+        self.__offAng = np.zeros(b)
+        self.__offVel = np.zeros((b, 2))
+        self.__offAngVel = np.zeros(b)
+        self.__offForce = np.zeros((b, 2))
+        self.__offTorque = np.zeros(b)
+        self.__offCog = np.zeros((b, 2))
+        self.__offMass = np.zeros(b)
+        self.__offMoment = np.zeros(b)
+        self.__offSynced = True
+        self.__isolationPos = None
+        self.__onlineIdx = np.arange(b)
+        self.__onlineBodies = list(self.__bodies)
+        self.__asleep = np.zeros(b, dtype=bool)
+        self.__sleepIsland = np.zeros(b, dtype=int)
+        self.__restCount = np.zeros(len(self.index_cube), dtype=int)
+        self.__wakePos = None
+
+    def __wakeIslands(self, angChange, elevation):
+        # wake the sleeping islands of worlds with a changing field and the ones an awake cube came close to
+        if not self.__asleep.any():
+            return
+        t0 = time.time()
+        self.__gatherPositions()
+        worlds = len(self.magAngles)
+        angChange = np.broadcast_to(angChange, (worlds,))
+        elevation = np.broadcast_to(elevation, (worlds,))
+        changed = (angChange != 0) | ((elevation != 0) & (elevation != self.magElevations))
+        wake = changed[self.__cubeWorld].copy()
+        cubeAsleep = self.__asleep[self.__bodyIndex]
+        # sleeping cubes don't move, so awake cubes have to move further than their clearance to get close
+        if self.__wakePos is None or \
+            np.any(np.sum((self.cubePos - self.__wakePos) ** 2, axis=1) >= self.__wakeClearance ** 2):
+            awake = np.nonzero(~cubeAsleep)[0]
+            sleeping = np.nonzero(cubeAsleep)[0]
+            diff = self.cubePos[awake][:, None, :] - self.cubePos[sleeping][None, :, :]
+            dist = np.sqrt(np.sum(diff ** 2, axis=2))
+            wake[sleeping[np.any(dist < StateHandler.WAKE_DISTANCE, axis=0)]] = True
+            self.__wakeClearance = np.full(len(self.cubePos), np.inf)
+            self.__wakeClearance[awake] = np.min(dist, axis=1, initial=np.inf) - StateHandler.WAKE_DISTANCE
+            self.__wakePos = self.cubePos.copy()
+        wake &= cubeAsleep
+        if wake.any():
+            # the whole island wakes up
+            islands = np.unique(self.__sleepIsland[self.__bodyIndex[wake]])
+            for n in np.nonzero(self.__asleep & np.isin(self.__sleepIsland, islands))[0]:
+                self.__bringOnline(n)
+                self.__asleep[n] = False
+            self.__updateOnline()
+            self.__isolationPos = None
+            self.__wakePos = None
+        self.timer.addToTask("Sleeping", time.time() - t0)
+
+    def __sleepIslands(self, vel, angVel, force, torque):
+        # put the islands to sleep whose cubes rested for SLEEP_UPDATES updates, if the net magnet, field and
+        # friction force and torque (given for every cube) can't move them faster than the sleep velocities
+        t0 = time.time()
+        cubeAsleep = self.__asleep[self.__bodyIndex]
+        resting = (np.sum(vel ** 2, axis=1) < StateHandler.SLEEP_VELOCITY ** 2) & \
+            (np.abs(angVel) < StateHandler.SLEEP_ANG_VELOCITY)
+        self.__restCount = np.where(resting & ~cubeAsleep, self.__restCount + 1, 0)
+        # check every SLEEP_UPDATES updates of a resting cube, the islands are expensive to find
+        count = self.__restCount
+        if not np.any((count >= StateHandler.SLEEP_UPDATES) & (count % StateHandler.SLEEP_UPDATES == 0)):
+            self.timer.addToTask("Sleeping", time.time() - t0)
+            return
+        awake = np.nonzero(~cubeAsleep)[0]
+        pos = self.cubePos[awake]
+        island = StateHandler.__islands(pos)
+        ids, inv = np.unique(island, return_inverse=True)
+        # net force and torque around the center of mass of each island
+        m = self.cubeMass[awake]
+        f = force[awake]
+        mass = np.bincount(inv, m)
+        center = np.stack((np.bincount(inv, m * pos[:, 0]), np.bincount(inv, m * pos[:, 1])), axis=-1) / mass[:, None]
+        r = pos - center[inv]
+        netForce = np.stack((np.bincount(inv, f[:, 0]), np.bincount(inv, f[:, 1])), axis=-1)
+        netTorque = np.bincount(inv, torque[awake] + r[:, 0] * f[:, 1] - r[:, 1] * f[:, 0])
+        moment = np.bincount(inv, m * ((2 * Cube.RAD) ** 2 / 6 + np.sum(r ** 2, axis=1)))
+        # the velocities the net force and torque would keep up against friction and angular damping
+        angDamping = -math.log(StateHandler.ANG_VEL_DAMP) / StateHandler.ANG_VEL_DAMP_TIME
+        calm = (np.sqrt(np.sum(netForce ** 2, axis=1)) < StateHandler.FRICTION_DAMPING * mass * StateHandler.SLEEP_VELOCITY) & \
+            (np.abs(netTorque) < angDamping * moment * StateHandler.SLEEP_ANG_VELOCITY)
+        calm &= np.bincount(inv, count[awake] < StateHandler.SLEEP_UPDATES) == 0
+        if not calm.any():
+            self.timer.addToTask("Sleeping", time.time() - t0)
+            return
+        cubes = awake[calm[inv]]
+        bodies = np.unique(self.__bodyIndex[cubes])
+        for n in bodies:
+            if not self.__offline[n]:
+                self.__takeOffline(n)
+        # sleeping bodies keep getting the forces of the field and friction, so they have them when they wake up
+        self.__offVel[bodies] = 0
+        self.__offAngVel[bodies] = 0
+        self.__asleep[bodies] = True
+        self.__sleepIsland[self.__bodyIndex[cubes]] = awake[island[calm[inv]]]
+        self.__offSynced = False
+        self.__updateOnline()
+        self.__keepSleepingConnections()
+        self.__wakePos = None
+        self.timer.addToTask("Sleeping", time.time() - t0)
+
+    @staticmethod
+    def __islands(pos):
+        # connected components of the cubes closer than WAKE_DISTANCE, each cube gets the smallest index of its component
+        i, j = np.triu_indices(len(pos), 1)
+        close = np.sum((pos[i] - pos[j]) ** 2, axis=1) < StateHandler.WAKE_DISTANCE ** 2
+        i, j = i[close], j[close]
+        label = np.arange(len(pos))
+        while True:
+            new = label.copy()
+            np.minimum.at(new, i, label[j])
+            np.minimum.at(new, j, label[i])
+            new = new[new]
+            if np.array_equal(new, label):
+                return label
+            label = new
+
+    def __keepSleepingConnections(self):
+        # sleeping cubes have no magnet pairs, their connections are carried over to the next update
+        asleep = self.__asleep[self.__bodyIndex]
+        self.magConnect[asleep] = self.magConnect_pre[asleep]
+        self.__connectCount = np.count_nonzero(self.magConnect >= 0)
+
+    def __cogRadius(self):
+        # vectors from the center of gravity of the bodies to the centers of their cubes
+        b = self.__bodyIndex
+        return StateHandler.__rotated(self.__cogOffset, np.cos(self.__bodyAng)[b], np.sin(self.__bodyAng)[b])
+
+    def __bodyForces(self, force, torque):
+        # sum up forces and torques (around the cube centers) of the cubes for each body
+        if len(self.__bodyCubes) == 0:
+            return force, torque
+        r = self.__cogRadius()
+        bodyForce = np.zeros((len(self.__bodies), 2))
+        bodyTorque = np.zeros(len(self.__bodies))
+        np.add.at(bodyForce, self.__bodyIndex, force)
+        np.add.at(bodyTorque, self.__bodyIndex, torque + r[:, 0] * force[:, 1] - r[:, 1] * force[:, 0])
+        return bodyForce, bodyTorque
+
+    def __applyForceFieldFriction(self):
         t0 = time.time()
-        shape = self.getCubeShape(cube)
-        ang = shape.body.angle
-        # We need to apply world force to world point
-        magPosN = shape.body.local_to_world(cube.magnetPos[Direction.NORTH.value])
-        magPosS = shape.body.local_to_world(cube.magnetPos[Direction.SOUTH.value])
-        force = Vec2d(0, math.sin(ang-self.magAngle) * StateHandler.MAG_FORCE_FIELD).rotated(ang)
-        shape.body.apply_force_at_local_point(-force, magPosS)
-        shape.body.apply_force_at_local_point( force, magPosN)
-        #self.cube_force[cube] += force
-        #self.cube_force[cube] += -force
+        self.__gatherPositions()
+        offline = self.__offline
+        bodyVel, bodyAngVel, vel, angVel = self.__readVelocities()
+        speed = np.sqrt(np.sum(bodyVel ** 2, axis=1))
+        self.__speedingUp = len(speed) != len(self.__bodySpeed) or bool(np.any(speed > self.__bodySpeed))
+        self.__bodySpeed = speed
+        self.__maxVelocity = np.max(speed, initial=0)
+        self.__maxAngVelocity = np.max(np.abs(bodyAngVel), initial=0)
+        coef, active, fricCubes = self.__frictionCoefficients()
+        # the north and south forces of the magnetic field only result in a torque
+        torque = -2 * Cube.MRAD * StateHandler.MAG_FORCE_FIELD * np.sin(self.cubeAng - self.magAngles[self.__cubeWorld])
         self.timer.addToTask("Calculate Magnetic Field Forces", time.time() - t0)
+        t0 = time.time()
+        elevation = self.magElevations[self.__cubeWorld]
+        tilted = elevation != Tilt.HORIZONTAL
+        # Apply full friction to cube, at COG
+        force = -1 * StateHandler.FRICTION_DAMPING * self.cubeMass[:, None] * vel
+        self.__fricPoints = self.cubePos
+        if tilted.any():
+            # apply the friction at the frictionpoint, friction cubes have a larger portion
+            rx = np.where(elevation == Tilt.NORTH_DOWN, -Cube.MRAD, Cube.MRAD)
+            r = np.stack((rx * np.cos(self.cubeAng), rx * np.sin(self.cubeAng)), axis=-1)
+            velPoint = vel + np.stack((-r[:, 1], r[:, 0]), axis=-1) * angVel[:, None]
+            tiltForce = (-1 * StateHandler.FRICTION_DAMPING * self.cubeMass * coef)[:, None] * velPoint
+            tiltTorque = r[:, 0] * tiltForce[:, 1] - r[:, 1] * tiltForce[:, 0]
+            if tilted.all():
+                force = tiltForce
+                torque += tiltTorque
+                self.__fricPoints = self.cubePos + r
+            else:
+                # worlds with different elevations
+                force = np.where(tilted[:, None], tiltForce, force)
+                torque += np.where(tilted, tiltTorque, 0)
+                self.__fricPoints = np.where(tilted[:, None], self.cubePos + r, self.cubePos)
+        self.__fricDrawn = fricCubes
+        if self.sleeping:
+            manualForce, manualTorque = force, torque
+            if self.__magnetForce is not None:
+                manualForce, manualTorque = force + self.__magnetForce, torque + self.__magnetTorque
+        # the load on the fused connections in the next update depends on the forces of the single cubes
+        self.__fieldForce, self.__fieldTorque = force, torque
+        force, torque = self.__bodyForces(force, torque)
+        bodyActive = np.zeros(len(self.__bodies), dtype=bool)
+        bodyActive[self.__bodyIndex[active]] = True
+        # damp the angular velocity
+        bodyAngVel *= StateHandler.ANG_VEL_DAMP
+        if offline.any():
+            # bodies outside the space get the forces for their own integration
+            update = offline & bodyActive
+            self.__offForce[update] = force[update]
+            self.__offTorque[update] = torque[update]
+            self.__offAngVel[update] = bodyAngVel[update]
+            bodyActive &= ~offline
+        for n in np.nonzero(bodyActive)[0]:
+            body = self.__bodies[n]
+            body.force = (force[n, 0], force[n, 1])
+            body.torque = torque[n]
+            body.angular_velocity = bodyAngVel[n]
+        self.timer.addToTask("Calculate Friction Forces", time.time() - t0)
+        if self.sleeping:
+            self.__sleepIslands(vel, angVel, manualForce, manualTorque)
+
+    def __readVelocities(self):
+        # velocities of the bodies and of the cube centers, the positions have to be gathered
+        if self.__offline.any():
+            bodyVel = self.__readBodies(self.__offVel, [body.velocity for body in self.__onlineBodies])
+            bodyAngVel = self.__readBodies(self.__offAngVel, [body.angular_velocity for body in self.__onlineBodies])
+        else:
+            bodyVel = np.array([body.velocity for body in self.__bodies], dtype=float).reshape((-1, 2))
+            bodyAngVel = np.array([body.angular_velocity for body in self.__bodies], dtype=float)
+        if len(self.__bodyCubes) == 0:
+            return bodyVel, bodyAngVel, bodyVel, bodyAngVel
+        r = self.__cogRadius()
+        angVel = bodyAngVel[self.__bodyIndex]
+        vel = bodyVel[self.__bodyIndex] + np.stack((-r[:, 1], r[:, 0]), axis=-1) * angVel[:, None]
+        return bodyVel, bodyAngVel, vel, angVel
+
+    def __frictionCoefficients(self):
+        # portion of the friction for each cube, only changes with the polyominoes or the elevations
+        key = self.magElevations.tobytes()
+        if key in self.__elevation_friction:
+            return self.__elevation_friction[key]
+        n = len(self.cube_bodies)
+        coef = np.zeros(n)
+        active = np.zeros(n, dtype=bool)
+        fricCubes = np.zeros(n, dtype=bool)
+        for poly in self.polyominoes.getAll():
+            geometry = poly.geometry()
+            idx = [self.cube_index[cube] for cube in geometry.cubes]
+            active[idx] = True
+            elevation = self.magElevations[self.__cubeWorld[idx[0]]]
+            if elevation == Tilt.HORIZONTAL:
+                coef[idx] = 1
+                fricCubes[idx] = True
+                continue
+            if elevation == Tilt.NORTH_DOWN:
+                frictionCubes = geometry.topRow
+            else:
+                frictionCubes = geometry.bottomRow
+            fidx = [self.cube_index[cube] for cube in frictionCubes]
+            coef[idx] = StateHandler.NOMINAL_FRICTION
+            coef[fidx] += (1 - StateHandler.NOMINAL_FRICTION) * len(idx) / len(frictionCubes)
+            fricCubes[fidx] = True
+        self.__elevation_friction[key] = (coef, active, fricCubes)
+        return coef, active, fricCubes
 
     def __sensorCollision(self, arbiter: pymunk.Arbiter, space, data): 
             cubei = self.sensor_cube[arbiter.shapes[0]]
             cubej = self.sensor_cube[arbiter.shapes[1]]
-            #self.criticalCubePairs.append((cubei, cubej))
-            self.__applyForceMagnets(cubei, cubej)
+            self.criticalCubePairs.append((cubei, cubej))
             return False
 
-    def __applyForceMagnets(self, cubei: Cube, cubej: Cube):
+    def __magnetHook(self, constraint, space):
         t0 = time.time()
-        shapei = self.getCubeShape(cubei)
-        shapej = self.getCubeShape(cubej)
-        angi = shapei.body.angle
-        angj = shapej.body.angle
-        # determine which pairs to consider
-        pairs = self.__magPairsMinDist(cubei, cubej)
-        # calc magnetic force for the determined magnet pairs
-        for i, j in pairs:
-            magPosi = shapei.body.local_to_world(cubei.magnetPos[i])
-            magOrii = cubei.magnetOri[i]
-            mi = Vec2d(magOrii[0],magOrii[1]).rotated(angi)
-            magPosj = shapej.body.local_to_world(cubej.magnetPos[j])
-            magOrij = cubej.magnetOri[j]
-            mj = Vec2d(magOrij[0],magOrij[1]).rotated(angj)
-            fionj = Cube.magForce1on2(magPosi, magPosj, mi, mj)
-            shapei.body.apply_force_at_world_point(-fionj, magPosi)
-            shapej.body.apply_force_at_world_point(fionj, magPosj)
-            # Determine magnet connections
-            if fionj.length >= StateHandler.CONNECTION_FORCE_MIN:
-                self.__connectMagnets(cubei, Direction(i), cubej, Direction(j))
-            #self.cube_force[cubei] += -fionj
-            #self.cube_force[cubej] += fionj
+        self.__gatherPositions()
+        if self.neighborList:
+            idxi, idxj = self.__criticalNeighbors()
+        else:
+            idxi = np.array([self.cube_index[cubei] for cubei, _ in self.criticalCubePairs], dtype=int)
+            idxj = np.array([self.cube_index[cubej] for _, cubej in self.criticalCubePairs], dtype=int)
+        if len(idxi) > 0:
+            self.__applyForceMagnets(idxi, idxj)
+        self.criticalCubePairs.clear()
         self.timer.addToTask("Calculate Magnet Forces", time.time() - t0)
 
-    def __magPairMinDist(self, cubei: Cube, cubej: Cube) -> list:
-        # determine the magnetpair with the smallest distance. Only one pair is returned
-        shapei = self.getCubeShape(cubei)
-        shapej = self.getCubeShape(cubej)
-        dismin = math.inf
-        for i in range(4):
-            magPosi = shapei.body.local_to_world(cubei.magnetPos[i])
-            magPosi = Vec2d(magPosi[0], magPosi[1])
-            for j in range(4):
-                magPosj = shapej.body.local_to_world(cubej.magnetPos[j])
-                dis = magPosi.get_distance(magPosj)
-                if dis < dismin:
-                    dismin = dis
-                    pair = (i,j)
-        return [pair]
-
-    def __magPairsMinDist(self, cubei: Cube, cubej: Cube) -> list:
-        # determine the magnetpairs with the smallest distance. In total 4 pairs are returned
-        pairs = []
-        shapei = self.getCubeShape(cubei)
-        shapej = self.getCubeShape(cubej)
-        for i in range(4):
-            dismin = math.inf
-            magPosi = shapei.body.local_to_world(cubei.magnetPos[i])
-            magPosi = Vec2d(magPosi[0], magPosi[1])
-            for j in range(4):
-                magPosj = shapej.body.local_to_world(cubej.magnetPos[j])
-                dis = magPosi.get_distance(magPosj)
-                if dis < dismin:
-                    dismin = dis
-                    pair = (i,j)
-            pairs.append(pair)
-        return pairs
-
-    def __magPairsAll(self, cubei: Cube, cubej: Cube) -> list:
-        # returns all magnetpairs. 16 in total
-        pairs = []
-        for i in range(4):
-            for j in range(4):
-                pairs.append((i,j))
-        return pairs
-
-    def __connectMagnets(self, cubei: Cube, edgei: Direction, cubej: Cube, edgej: Direction):
+    def __criticalNeighbors(self):
+        # rebuild the neighbor list if a cube could have moved into the magnet distance of a cube not in the list
+        pos = self.cubePos
+        if self.__neighborPos is None or len(self.__neighborPos) != len(pos) or \
+            np.max(np.sum((pos - self.__neighborPos) ** 2, axis=1), initial=0) > (StateHandler.NEIGHBOR_SKIN / 2) ** 2:
+            t0 = time.time()
+            cutoff = Cube.MAG_DISTANCE_MIN + StateHandler.NEIGHBOR_SKIN
+            pairs = np.array(np.triu_indices(len(pos), 1), dtype=int).reshape((2, -1))
+            diff = pos[pairs[0]] - pos[pairs[1]]
+            self.__neighborPairs = pairs[:, np.sum(diff ** 2, axis=1) < cutoff ** 2]
+            self.__neighborPos = pos.copy()
+            self.timer.addToTask("Build Neighbor List", time.time() - t0)
+        # same criteria as the overlap of two sensor circles
+        idxi, idxj = self.__neighborPairs
+        diff = pos[idxi] - pos[idxj]
+        critical = np.sum(diff ** 2, axis=1) < Cube.MAG_DISTANCE_MIN ** 2
+        # like sensors of the same body, cubes of the same body don't interact
+        critical &= self.__bodyIndex[idxi] != self.__bodyIndex[idxj]
+        if self.__asleep.any():
+            asleep = self.__asleep[self.__bodyIndex]
+            critical &= ~asleep[idxi] & ~asleep[idxj]
+        return idxi[critical], idxj[critical]
+
+    def __applyForceMagnets(self, idxi, idxj):
+        # calculate the magnet forces of all critical cube pairs at once
+        pos = self.cubePos
+        ang = self.cubeAng
+        # world positions and orientations of the magnets, once for every cube
+        cos, sin = np.cos(ang)[:, None], np.sin(ang)[:, None]
+        magPos = StateHandler.__rotated(StateHandler.MAGNET_POS, cos, sin) + pos[:, None, :]
+        magOri = StateHandler.__rotated(self.magnetOri, cos, sin)
+        magPosi = magPos[idxi]
+        # the magnet of cubej nearest to a magnet of cubei is the one pointing towards it
+        diff = magPosi - pos[idxj][:, None, :]
+        x = diff[..., 0] * cos[idxj] + diff[..., 1] * sin[idxj]
+        y = diff[..., 1] * cos[idxj] - diff[..., 0] * sin[idxj]
+        pairsj = StateHandler.NEAREST_MAGNET[4 * (np.abs(x) >= np.abs(y)) + 2 * (x < 0) + (y < 0)]
+        magPosj = magPos[idxj[:, None], pairsj]
+        mi = magOri[idxi]
+        mj = magOri[idxj[:, None], pairsj]
+        # calc magnetic force for the determined magnet pairs and the resulting torques
+        fionj = Cube.magForces1on2(magPosi, magPosj, mi, mj)
+        ri = magPosi - pos[idxi][:, None, :]
+        rj = magPosj - pos[idxj][:, None, :]
+        force = np.zeros((len(pos), 2))
+        torque = np.zeros(len(pos))
+        np.add.at(force, idxi, -fionj.sum(axis=1))
+        np.add.at(force, idxj, fionj.sum(axis=1))
+        np.add.at(torque, idxi, -(ri[..., 0] * fionj[..., 1] - ri[..., 1] * fionj[..., 0]).sum(axis=1))
+        np.add.at(torque, idxj, (rj[..., 0] * fionj[..., 1] - rj[..., 1] * fionj[..., 0]).sum(axis=1))
+        if self.sleeping or len(self.__bodyCubes) > 0:
+            self.__magnetForce, self.__magnetTorque = force, torque
+        force, torque = self.__bodyForces(force, torque)
+        for n in np.unique(self.__bodyIndex[np.concatenate((idxi, idxj))]):
+            body = self.__bodies[n]
+            body.force += Vec2d(force[n, 0], force[n, 1])
+            body.torque += torque[n]
+        # Determine magnet connections
+        connected = np.sqrt(fionj[..., 0] ** 2 + fionj[..., 1] ** 2) >= StateHandler.CONNECTION_FORCE_MIN
+        for p, i in zip(*np.nonzero(connected)):
+            self.__connectMagnets(idxi[p], i, idxj[p], pairsj[p, i])
+
+    @staticmethod
+    def __rotated(vecs, cos, sin):
+        # rotates an array of vectors (..., 4, 2) by the angles given as cos and sin (..., 1)
+        return np.stack((vecs[..., 0] * cos - vecs[..., 1] * sin, vecs[..., 0] * sin + vecs[..., 1] * cos), axis=-1)
+
+    def __connectMagnets(self, i, edgei, j, edgej):
         # check if there already is a connection
-        if cubej in self.magConnect[cubei]:
+        if j in self.magConnect[i]:
             return
         # edges should in inverse of each other
-        if edgei.inv() != edgej:
+        if (edgei + 2) % 4 != edgej:
             return
         # prevent side connection of same cube type
-        if (edgei in (Direction.WEST, Direction.EAST)) and cubei.type == cubej.type:
+        if (edgei in (Direction.WEST.value, Direction.EAST.value)) and self.index_cube[i].type == self.index_cube[j].type:
             return
-        # connect the cubes by adding them to magConnect map
-        self.magConnect[cubei][edgei.value] = cubej
-        self.magConnect[cubej][edgej.value] = cubei
+        # connect the cubes by adding their indices to magConnect
+        self.__setConnection(i, edgei, j)
+        self.__setConnection(j, edgej, i)
         # JOINTS
         # self.__addConnectionJoint__(cubei, edgei, cubej, edgej)
 
-    def __applyForceFriction(self, cube: Cube, poly: Polyomino):
-        t0 = time.time()
-        shape = self.getCubeShape(cube)
-        # calculate friction force without velocity yet
-        force = -1 * StateHandler.FRICTION_DAMPING * shape.mass
-        if self.magElevation == Tilt.HORIZONTAL:
-            # Apply full friction to cube, at COG
-            force *= shape.body.velocity
-            shape.body.apply_force_at_world_point(force, shape.body.position)
-            # just for drawing
-            self.frictionpoints[shape] = shape.body.position
-        else:
-            # define the cubes in poly the have the most friction and the frictionpoint
-            if self.magElevation == Tilt.NORTH_DOWN:
-                frictionCubes = set(poly.getTopRow())
-                fricPoint = shape.body.local_to_world((-Cube.MRAD, 0))
-            elif self.magElevation == Tilt.SOUTH_DOWN:
-                frictionCubes = set(poly.getBottomRow())
-                fricPoint = shape.body.local_to_world((Cube.MRAD, 0))
-            # apply partial friction to cube at the frictionpoint
-            force *= shape.body.velocity_at_world_point(fricPoint)
-            shape.body.apply_force_at_world_point(
-                StateHandler.NOMINAL_FRICTION * force, fricPoint)
-            if cube in frictionCubes:
-                # apply the rest if it is a friction cube
-                #shape.body.apply_force_at_world_point(-self.cube_force[cube] / len(frictionCubes), fricPoint)
-                shape.body.apply_force_at_world_point(
-                    (1 - StateHandler.NOMINAL_FRICTION) * force * poly.size() / len(frictionCubes), fricPoint)
-                self.frictionpoints[shape] = fricPoint  # just for drawing
-        # damp the angular velocity
-        shape.body.angular_velocity *= StateHandler.ANG_VEL_DAMP
-        self.timer.addToTask("Calculate Friction Forces", time.time() - t0)
+    def __setConnection(self, i, edge, j):
+        # counting the connections and comparing them with the previous ones makes change detection O(1)
+        if self.magConnect[i, edge] < 0:
+            self.__connectCount += 1
+        self.magConnect[i, edge] = j
+        if self.magConnect_pre[i, edge] != j:
+            self.__connectChanged = True
+
+    def __keepCubes(self, cubes: set) -> dict:
+        # take the cubes in cubes out of the space and return their shapes, pymunk drops their contacts with it
+        for body in list(self.__bodyCubes.keys()):
+            self.__splitBody(body)
+        kept = {}
+        for cube, shapes in self.cube_shapes.items():
+            if cube in cubes:
+                kept[cube] = shapes
+                self.space.remove(shapes[0].body, *(s for s in shapes if s != None))
+        return kept
 
     def __resetSpace(self):
         # delete space and all dicts
         del self.space
         self.bounds.clear()
+        self.__clearCubes()
+        self.__createSpace()
+
+    def __clearCubes(self):
         self.cube_shapes.clear()
         self.sensor_cube.clear()
-        self.cube_force.clear()
-        self.magConnect.clear()
+        # saved configurations share the old ones
+        self.cube_index = {}
+        self.index_cube = []
+        self.cube_bodies.clear()
+        self.magnetOri = np.zeros((0, 4, 2))
+        self.cubeMass = np.zeros(0)
+        self.__cubeWorld = np.zeros(0, dtype=int)
+        self.__bodies.clear()
+        self.__bodyIndex = np.zeros(0, dtype=int)
+        self.__bodyCubes.clear()
+        self.__cubeOffset = np.zeros((0, 2))
+        self.__cubeAngOffset = np.zeros(0)
+        self.__cogOffset = np.zeros((0, 2))
+        self.__fusedConnect = np.full((0, 4), -1)
+        self.__fusedCount = 0
+        self.__fuseCountdown = np.zeros(0, dtype=int)
+        self.__cuts = None
+        self.__cubeMoment = np.zeros(0)
+        self.__fieldForce = None
+        self.__fieldTorque = None
+        self.__gathered = False
+        self.__maxVelocity = 0
+        self.__maxAngVelocity = 0
+        self.__bodySpeed = np.zeros(0)
+        self.__elevation_friction.clear()
+        self.magConnect = np.full((0, 4), -1)
+        self.magConnect_pre = np.full((0, 4), -1)
+        self.__connectCount = 0
+        self.__connectCount_pre = 0
+        self.__connectChanged = False
+        self.__undetected.clear()
+        self.criticalCubePairs.clear()
+        self.__neighborPairs = np.zeros((2, 0), dtype=int)
+        self.__neighborPos = None
+
+    def __createSpace(self):
         # setup new space
         self.space = pymunk.Space()
         self.space.gravity = (0, 0)  # gravity doesn't exist
@@ -329,46 +963,329 @@ class StateHandler:
         cHandler = self.space.add_collision_handler(
             StateHandler.SENSOR_CTYPE, StateHandler.SENSOR_CTYPE)
         cHandler.pre_solve = self.__sensorCollision
+        # pymunk presolves constraints after all collisions are detected and before the velocities are integrated.
+        # A constraint without force is used to calculate the magnet forces for all collected cube pairs at that point.
+        hookBody = pymunk.Body(1, 1)
+        magnetHook = pymunk.GearJoint(self.space.static_body, hookBody, 0, 1)
+        magnetHook.max_force = 0
+        magnetHook.pre_solve = self.__magnetHook
+        self.space.add(hookBody, magnetHook)
 
-    def __addCube(self, cube: Cube, pos, ang, vel):
+    def __addCube(self, cube: Cube, pos, ang, vel, shapes=None):
         if cube in self.cube_shapes:
             return
-        # create the cube body
-        body = pymunk.Body()
-        body.position = pos
-        body.angle = ang
-        body.velocity = vel
-        # create the cube shape
-        shape = pymunk.Poly(body, [(-Cube.RAD, -Cube.RAD), (-Cube.RAD, Cube.RAD),
-                            (Cube.RAD, Cube.RAD), (Cube.RAD, -Cube.RAD)], radius=1)
+        if shapes == None:
+            # create the cube body
+            body = pymunk.Body()
+            body.position = pos
+            body.angle = ang
+            body.velocity = vel
+            # add to space and dictionarys
+            shape, magSensor = self.__createShapes(cube, body, (0, 0), 0)
+            if magSensor == None:
+                self.space.add(body, shape)
+            else:
+                self.space.add(body, magSensor, shape)
+        else:
+            # reuse the body of the last configuration
+            shape, magSensor = shapes
+            body = shape.body
+            # a step without time clears the bias velocities pymunk left from the last contacts
+            pymunk.Body.update_position(body, 0)
+            body.position = pos
+            body.angle = ang
+            body.velocity = vel
+            body.angular_velocity = 0
+            body.force = (0, 0)
+            body.torque = 0
+            if magSensor == None:
+                self.space.add(body, shape)
+            else:
+                self.space.add(body, magSensor, shape)
+                self.sensor_cube[magSensor] = cube
+        self.cube_index[cube] = len(self.cube_shapes)
+        self.index_cube.append(cube)
+        self.cube_shapes[cube] = (shape, magSensor)
+        self.cube_bodies.append(body)
+        self.__bodies.append(body)
+
+    def __allocateArrays(self):
+        # arrays with one row per cube, each cube has its own body after adding
+        n = len(self.index_cube)
+        self.magnetOri = StateHandler.MAGNET_ORI[[cube.type for cube in self.index_cube]].reshape((n, 4, 2))
+        self.cubeMass = np.array([self.cube_shapes[cube][0].mass for cube in self.index_cube], dtype=float)
+        self.magConnect = np.full((n, 4), -1)
+        self.magConnect_pre = np.full((n, 4), -1)
+        self.__bodyIndex = np.arange(n)
+        self.__cubeOffset = np.zeros((n, 2))
+        self.__cubeAngOffset = np.zeros(n)
+        self.__cogOffset = np.zeros((n, 2))
+        self.__fusedConnect = np.full((n, 4), -1)
+        self.__fuseCountdown = np.zeros(n, dtype=int)
+        self.__cubeMoment = np.array([self.cube_shapes[cube][0].moment for cube in self.index_cube], dtype=float)
+        self.__fieldForce = None
+        self.__fieldTorque = None
+        self.__neighborPos = None
+        self.__elevation_friction.clear()
+
+    def __createShapes(self, cube: Cube, body: pymunk.Body, offset, angle):
+        # create the cube shape at offset and angle relative to the body
+        verts = [Vec2d(x, y).rotated(angle) + offset for x, y in
+                 [(-Cube.RAD, -Cube.RAD), (-Cube.RAD, Cube.RAD), (Cube.RAD, Cube.RAD), (Cube.RAD, -Cube.RAD)]]
+        shape = pymunk.Poly(body, verts, radius=1)
         shape.mass = 10
         shape.elasticity = 0.4
         shape.friction = 0.4
+        if self.neighborList:
+            return shape, None
         # create sensor-shape that identifies a magnet attraction
-        magSensor = pymunk.Circle(body, Cube.MAG_DISTANCE_MIN / 2)
+        magSensor = pymunk.Circle(body, Cube.MAG_DISTANCE_MIN / 2, offset)
         magSensor.collision_type = StateHandler.SENSOR_CTYPE
         magSensor.sensor = True
-        # add to space and dictionarys
-        self.space.add(body, magSensor, shape)
-        self.cube_shapes[cube] = (shape, magSensor)
-        self.magConnect[cube] = [None] * 4
-        self.cube_force[cube] = Vec2d(0,0)
         self.sensor_cube[magSensor] = cube
+        return shape, magSensor
+
+    def __updateBodies(self, changed):
+        # split the compound bodies of the changed polyominoes and fuse the polyominoes again. Both go in cube
+        # order, so the bodies don't depend on the cube ids.
+        changed = sorted(changed, key=self.cube_index.get)
+        polys = {}
+        for cube in changed:
+            if cube in self.polyominoes.cube_poly:
+                poly = self.polyominoes.getForCube(cube)
+                polys[id(poly)] = poly
+        cubes = set(changed)
+        for poly in polys.values():
+            cubes.update(poly.getCubes())
+        for body in dict.fromkeys(self.cube_bodies[n] for n in sorted(self.cube_index[cube] for cube in cubes)):
+            if body in self.__bodyCubes:
+                self.__splitBody(body)
+        for poly in polys.values():
+            if poly.size() > 1:
+                self.__fuseBodies(poly)
+        self.__indexBodies()
+
+    def __indexBodies(self):
+        # rebuild the body index in order of the cubes
+        index = {}
+        self.__bodies.clear()
+        for n, body in enumerate(self.cube_bodies):
+            if not body in index:
+                index[body] = len(self.__bodies)
+                self.__bodies.append(body)
+            self.__bodyIndex[n] = index[body]
+        self.__fusedCount = np.count_nonzero(self.__fusedConnect >= 0)
+        self.__cuts = None
+        self.__neighborPos = None
+        self.__gathered = False
+
+    def __dissolveOverloaded(self, bodyVel, bodyAngVel, dt):
+        # compound bodies whose connections got overloaded in the step become single cubes again. They keep their
+        # magnetic connections until the magnets of the single cubes lose them, see __overloaded.
+        if all(self.__asleep[self.__bodyIndex[idx[0]]] for idx in self.__bodyCubes.values()):
+            return
+        force, torque = self.__internalForces(bodyVel, bodyAngVel, dt)
+        overloaded = self.__overloaded(force, torque)
+        overloaded = [body for body in overloaded if not self.__asleep[self.__bodyIndex[self.__bodyCubes[body][0]]]]
+        if len(overloaded) == 0:
+            return
+        self.__wakeAll()
+        for body in overloaded:
+            idx = self.__bodyCubes[body]
+            self.__splitBody(body)
+            self.__fuseCountdown[idx] = StateHandler.FUSE_DELAY
+        self.__indexBodies()
+        self.__resetOffline()
+
+    def __fuseAgain(self):
+        # the polyominoes of dissolved bodies are fused again FUSE_DELAY updates later if they are still connected
+        counting = self.__fuseCountdown > 0
+        self.__fuseCountdown[counting] -= 1
+        due = counting & (self.__fuseCountdown == 0)
+        if due.any():
+            self.__wakeAll()
+            self.__updateBodies({self.index_cube[n] for n in np.nonzero(due)[0]})
+            self.__resetOffline()
+
+    def __internalForces(self, bodyVel, bodyAngVel, dt):
+        # force and torque the rest of its body applied to each cube in the step, so that the cube moved rigidly
+        # with the body despite the field, friction, magnet and contact forces on it
+        self.__gatherPositions()
+        vel, angVel, _, _ = self.__readVelocities()
+        b = self.__bodyIndex
+        r = self.__cogRadius()
+        acc = (vel - bodyVel) / dt
+        angAcc = (angVel - bodyAngVel) / dt
+        cubeAcc = acc[b] + np.stack((-r[:, 1], r[:, 0]), axis=-1) * angAcc[b][:, None] - r * (angVel[b] ** 2)[:, None]
+        force = self.cubeMass[:, None] * cubeAcc
+        torque = self.__cubeMoment * angAcc[b]
+        if self.__fieldForce is not None:
+            force -= self.__fieldForce
+            torque -= self.__fieldTorque
+        if self.__magnetForce is not None:
+            force -= self.__magnetForce
+            torque -= self.__magnetTorque
+        # contact impulses of the compound bodies, the impulse of an arbiter is applied at its mean contact point
+        for body, idx in self.__bodyCubes.items():
+            shapes = {self.cube_shapes[self.index_cube[n]][0]: n for n in idx}
+            for arbiter in self.__arbiters(body):
+                n = shapes.get(arbiter.shapes[0], shapes.get(arbiter.shapes[1]))
+                if n is None:
+                    continue
+                impulse = arbiter.total_impulse
+                if not arbiter.shapes[0] in shapes:
+                    impulse = -impulse
+                points = arbiter.contact_point_set.points
+                if len(points) == 0:
+                    continue
+                point = sum((p.point_a for p in points), Vec2d(0, 0)) / len(points)
+                force[n] -= (impulse[0] / dt, impulse[1] / dt)
+                torque[n] -= (point - Vec2d(*self.cubePos[n])).cross(impulse) / dt
+        return force, torque
+
+    @staticmethod
+    def __arbiters(body: pymunk.Body) -> list:
+        arbiters = []
+        body.each_arbiter(arbiters.append)
+        return arbiters
+
+    def __findCuts(self):
+        # The lines between fused cubes that split a compound body in two, each one as the cubes on one side of it
+        # and the connections (k, l) across it. They only depend on the layout of the compound bodies, so they are
+        # kept until the bodies change. The cuts are stored back to back with the start of each one.
+        pos = self.cubePos
+        connect = self.__fusedConnect
+        sides, crossings = [], []
+        for idx in self.__bodyCubes.values():
+            found = set()
+            for i in idx:
+                for j in connect[i]:
+                    if j < 0:
+                        continue
+                    normal = pos[j] - pos[i]
+                    mid = (pos[i] + pos[j]) / 2
+                    # the cubes connected to cube i without crossing the line
+                    side = [i]
+                    for k in side:
+                        side.extend(l for l in connect[k] if l >= 0 and not l in side and np.dot(pos[l] - mid, normal) < 0)
+                    key = frozenset(side)
+                    if key in found:
+                        continue
+                    found.add(key)
+                    sides.append(side)
+                    crossings.append([(k, l) for k in side for l in connect[k] if l >= 0 and not l in key])
+        sideStart = np.cumsum([0] + [len(side) for side in sides[:-1]])
+        crossStart = np.cumsum([0] + [len(cross) for cross in crossings[:-1]])
+        crossings = np.array([c for cross in crossings for c in cross], dtype=int).reshape(-1, 2)
+        self.__cuts = (np.array([k for side in sides for k in side], dtype=int), sideStart,
+                       crossings[:, 0], crossings[:, 1], crossStart)
+
+    def __overloaded(self, force, torque) -> list:
+        # A connection is overloaded when the magnets across the line between its cubes can't transmit the load
+        # of the cubes on one side of it. The faces pivot about one end of the line, the contact there pushes
+        # and each magnet pulls with at most CONNECTION_FORCE_MIN, the force at which the single cubes count as
+        # disconnected. Returns the bodies with an overloaded connection.
+        if self.__cuts is None:
+            self.__findCuts()
+        side, sideStart, k, l, crossStart = self.__cuts
+        pos = self.cubePos
+        sideCut = np.repeat(np.arange(len(sideStart)), np.diff(np.append(sideStart, len(side))))
+        crossCount = np.diff(np.append(crossStart, len(k)))
+        crossCut = np.repeat(np.arange(len(crossStart)), crossCount)
+        # positions of the magnets along the line, measured from the middle of the cut
+        mids = (pos[k] + pos[l]) / 2
+        center = np.add.reduceat(mids, crossStart) / crossCount[:, None]
+        normal = pos[l[crossStart]] - pos[k[crossStart]]
+        tangent = np.stack((-normal[:, 1], normal[:, 0]), axis=-1) / np.sqrt(np.sum(normal ** 2, axis=-1))[:, None]
+        s = np.sum((mids - center[crossCut]) * tangent[crossCut], axis=-1)
+        sPlus = np.maximum.reduceat(s, crossStart) + Cube.RAD
+        sMinus = np.minimum.reduceat(s, crossStart) - Cube.RAD
+        holdPlus = np.add.reduceat(sPlus[crossCut] - s, crossStart) * StateHandler.CONNECTION_FORCE_MIN
+        holdMinus = np.add.reduceat(s - sMinus[crossCut], crossStart) * StateHandler.CONNECTION_FORCE_MIN
+        # load on the side about the center and about both ends of the line
+        d = pos[side] - center[sideCut]
+        sideForce = np.add.reduceat(force[side], sideStart)
+        moment = np.add.reduceat(torque[side] + d[:, 0] * force[side, 1] - d[:, 1] * force[side, 0], sideStart)
+        tangentForce = tangent[:, 0] * sideForce[:, 1] - tangent[:, 1] * sideForce[:, 0]
+        over = (moment - sPlus * tangentForce > holdPlus) | (moment - sMinus * tangentForce < -holdMinus)
+        return list(dict.fromkeys(self.cube_bodies[n] for n in side[sideStart[over]]))
+
+    def __fuseBodies(self, poly: Polyomino):
+        # replace the bodies of the cubes in poly with one compound body, linear and angular momentum are kept
+        cubes = sorted(poly.getCubes(), key=self.cube_index.get)
+        idx = [self.cube_index[cube] for cube in cubes]
+        poses = [self.getCubePose(cube) for cube in cubes]
+        # in order of the cubes, so the sums below don't depend on where the bodies are in memory
+        oldBodies = list(dict.fromkeys(self.cube_bodies[n] for n in idx))
+        mass = sum(old.mass for old in oldBodies)
+        cog = sum((old.local_to_world(old.center_of_gravity) * old.mass for old in oldBodies), Vec2d(0, 0)) / mass
+        vel = sum((old.velocity * old.mass for old in oldBodies), Vec2d(0, 0)) / mass
+        angMomentum = sum(old.moment * old.angular_velocity +
+                          old.mass * (old.local_to_world(old.center_of_gravity) - cog).cross(old.velocity - vel) for old in oldBodies)
+        for old in oldBodies:
+            self.__removeBody(old)
+        body = pymunk.Body()
+        body.position, body.angle = poses[0]
+        shapes = []
+        for cube, n, (pos, ang) in zip(cubes, idx, poses):
+            offset = body.world_to_local(pos)
+            shape, magSensor = self.__createShapes(cube, body, offset, ang - body.angle)
+            shapes.extend(s for s in (magSensor, shape) if s != None)
+            self.cube_shapes[cube] = (shape, magSensor)
+            self.cube_bodies[n] = body
+            self.__cubeOffset[n] = offset
+            self.__cubeAngOffset[n] = ang - body.angle
+            self.__fusedConnect[n] = [self.cube_index[c] if c != None else -1 for c in poly.getConnected(cube)]
+        self.__fuseCountdown[idx] = 0
+        self.space.add(body, *shapes)
+        self.__cogOffset[idx] = self.__cubeOffset[idx] - body.center_of_gravity
+        self.__bodyCubes[body] = idx
+        body.velocity = vel
+        body.angular_velocity = angMomentum / body.moment
+
+    def __splitBody(self, body: pymunk.Body):
+        # give each cube of the compound body its own body again
+        idx = self.__bodyCubes.pop(body)
+        for n in idx:
+            cube = self.index_cube[n]
+            pos, ang = self.getCubePose(cube)
+            single = pymunk.Body()
+            single.position = pos
+            single.angle = ang
+            single.velocity = body.velocity_at_world_point(pos)
+            single.angular_velocity = body.angular_velocity
+            shape, magSensor = self.__createShapes(cube, single, (0, 0), 0)
+            self.space.add(single, *(s for s in (magSensor, shape) if s != None))
+            self.cube_shapes[cube] = (shape, magSensor)
+            self.cube_bodies[n] = single
+        self.__cubeOffset[idx] = 0
+        self.__cubeAngOffset[idx] = 0
+        self.__cogOffset[idx] = 0
+        self.__fusedConnect[idx] = -1
+        self.__removeBody(body)
+
+    def __removeBody(self, body: pymunk.Body):
+        for shape in body.shapes:
+            self.sensor_cube.pop(shape, None)
+        self.space.remove(body, *body.shapes)
 
     def __addBoundaries(self):
         r = StateHandler.BOUNDARIE_RAD
-        w = self.boardSize[0] - StateHandler.BOUNDARIE_RAD / 4
-        h = self.boardSize[1] - StateHandler.BOUNDARIE_RAD / 4
-        self.bounds = [
-            pymunk.Segment(self.space.static_body, (0, 0), (w, 0), r),
-            pymunk.Segment(self.space.static_body, (w, 0), (w, h), r),
-            pymunk.Segment(self.space.static_body, (w, h), (0, h), r),
-            pymunk.Segment(self.space.static_body, (0, h), (0, 0), r)
-        ]
-        for wall in self.bounds:
-            wall.elasticity = 0.4
-            wall.friction = 0.5
-            self.space.add(wall)
+        self.bounds = []
+        for boardSize, (x, y) in zip(self.__boardSizes, self.__worldOffset):
+            w = x + boardSize[0] - StateHandler.BOUNDARIE_RAD / 4
+            h = y + boardSize[1] - StateHandler.BOUNDARIE_RAD / 4
+            walls = [
+                pymunk.Segment(self.space.static_body, (x, y), (w, y), r),
+                pymunk.Segment(self.space.static_body, (w, y), (w, h), r),
+                pymunk.Segment(self.space.static_body, (w, h), (x, h), r),
+                pymunk.Segment(self.space.static_body, (x, h), (x, y), r)
+            ]
+            for wall in walls:
+                wall.elasticity = 0.4
+                wall.friction = 0.5
+                self.space.add(wall)
+            self.bounds.extend(walls)
 
 # ------------------------------------DEPRECATED----------------------------------------------
     # def __updatePivotPiont__(self, poly: Polyomino):
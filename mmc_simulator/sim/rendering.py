@@ -59,11 +59,11 @@ class Renderer:
         self.__drawWalls()
         # draw the cubes
         for cube in self.__stateHandler.getCubes():
-            shape = self.__stateHandler.getCubeShape(cube)
-            self.__drawCube(cube, shape.body.position, shape.body.angle)
-            # draw friction points
-            if shape in self.__stateHandler.frictionpoints:
-                pygame.draw.circle(self.__window, Renderer.PURPLE, self.__stateHandler.frictionpoints[shape], 3)
+            pos, ang = self.__stateHandler.getCubePose(cube)
+            self.__drawCube(cube, pos, ang)
+        # draw friction points
+        for point in self.__stateHandler.getFrictionPoints():
+            pygame.draw.circle(self.__window, Renderer.PURPLE, point, 3)
         # draw user points and lines
         for point in self.pointsToDraw:
             pygame.draw.circle(self.__window, point[0], point[1], point[2])
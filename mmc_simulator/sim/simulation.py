@@ -6,6 +6,7 @@ Holds the Simulation class
 import time
 import pygame
 import math
+import numpy as np
 from queue import Queue
 
 from com.state import Configuration, Cube
@@ -34,8 +35,13 @@ class Simulation:
 
     # (in seconds) bigger steps make sim faster but unprecise/unstable 0.05 seems reasonable
     STEP_TIME = 0.07
+    # velocities (px/s and rad/s) below which the cubes count as resting and how many steps they have to rest
+    SETTLE_VELOCITY = 2
+    SETTLE_ANG_VELOCITY = 0.05
+    SETTLE_UPDATES = 3
 
-    def __init__(self, drawing=True, userControls=True):
+    def __init__(self, drawing=True, userControls=True, neighborList=False, compoundBodies=False, settle=False, multiRate=False,
+                 sleeping=False):
         """
         creates a Simulation with empty configuration
 
@@ -44,11 +50,18 @@ class Simulation:
             height: screen height
             drawing: if the simulation should draw
             userControls: if the user is able to alter the simulation state
+            neighborList: if magnet pairs are found with a neighbor list instead of pymunk sensor collisions
+            compoundBodies: if the cubes of each polyomino are simulated as one rigid body, an approximation that
+                can end in other polyominoes than the default, see StateHandler
+            settle: if idle and rotation stall steps end as soon as all cubes are resting
+            multiRate: if isolated cubes and polyominoes are integrated without collisions and magnets
+            sleeping: if resting groups of cubes leave the simulation until the field changes or something comes close
         """
         self.drawingActive = drawing
         self.userControls = userControls
+        self.settle = settle
 
-        self.stateHandler = StateHandler()
+        self.stateHandler = StateHandler(neighborList, compoundBodies, multiRate=multiRate, sleeping=sleeping)
         self.renderer = Renderer(self.stateHandler)
         if self.drawingActive:
             self.renderer.pygameInit()
@@ -81,26 +94,33 @@ class Simulation:
             print("Configuration saved.")
         return save
 
-    def executeMotion(self, motion: Motion):
+    def executeMotion(self, motion: Motion) -> int:
         """
         Simulates a motion returns when the motion is finished executing.
 
         Parameters:
             motion: motion to execute
+
+        Returns:
+            the number of steps that got simulated
         """
-        self.__addMotionSteps(motion)
-        self.__run()
+        return self.executeMotions([motion])
 
-    def executeMotions(self, motions: list):
+    def executeMotions(self, motions: list) -> int:
         """
         Simulates a list of motions returns when all motions are finished executing.
 
         Parameters:
             motions: list of motions to execute
+
+        Returns:
+            the number of steps that got simulated
         """
+        if not self.drawingActive:
+            return self.__runHeadless(self.__compileMotions(motions))
         for motion in motions:
             self.__addMotionSteps(motion)
-        self.__run()
+        return self.__run()
 
     def terminate(self) -> Configuration:
         """
@@ -133,8 +153,10 @@ class Simulation:
         self.renderer.pygameInit()
         self.drawingActive = True
 
-    def __run(self):
+    def __run(self) -> int:
         # Simulation loop
+        updates = 0
+        resting = 0
         while not self.motionSteps.empty():
             tt = time.time()
             if self.drawingActive:
@@ -146,6 +168,53 @@ class Simulation:
             if self.drawingActive and self.update % self.updatePerFrame == 0: #or not self.started.is_set()
                 self.renderer.render(self.fps)
             self.update += 1
+            updates += 1
+            # skip the remaining settle steps when the cubes rested long enough
+            resting, skip = self.__settled(resting, step.settle)
+            if skip:
+                while not self.motionSteps.empty() and self.motionSteps.queue[0].settle:
+                    self.motionSteps.get()
+        return updates
+
+    def __runHeadless(self, steps) -> int:
+        # Simulation loop without drawing, user inputs and step queue
+        tt = time.time()
+        update = self.stateHandler.update
+        angChanges = steps[:, 0].tolist()
+        elevations = steps[:, 1].astype(int).tolist()
+        settles = steps[:, 2].astype(bool).tolist()
+        resting = 0
+        updates = 0
+        i = 0
+        while i < len(angChanges):
+            update(angChanges[i], elevations[i], Simulation.STEP_TIME)
+            updates += 1
+            i += 1
+            # skip the remaining settle steps when the cubes rested long enough
+            resting, skip = self.__settled(resting, settles[i - 1])
+            if skip:
+                while i < len(settles) and settles[i]:
+                    i += 1
+        self.update += updates
+        self.stateHandler.timer.addToTotal(time.time() - tt)
+        return updates
+
+    def __settled(self, resting, settle) -> tuple:
+        # counts the updates in a row the cubes rested at the end of a settle step. Returns the new count and if
+        # the remaining settle steps get skipped, which starts the count over.
+        if self.settle and settle and self.stateHandler.isResting(Simulation.SETTLE_VELOCITY, Simulation.SETTLE_ANG_VELOCITY):
+            resting += 1
+        else:
+            resting = 0
+        if resting >= Simulation.SETTLE_UPDATES:
+            return 0, True
+        return resting, False
+
+    def __compileMotions(self, motions) -> np.ndarray:
+        # step arrays of all motions, the longest chain is taken from the current polyominoes like in __addMotionSteps
+        longestChain = max(self.stateHandler.polyominoes.maxWidth, self.stateHandler.polyominoes.maxHeight)
+        steps = [motion.stepArray(Simulation.STEP_TIME, longestChain) for motion in motions]
+        return np.concatenate(steps) if len(steps) > 0 else np.zeros((0, 3))
 
     def __addMotionSteps(self, motion):
         longestChain = max(self.stateHandler.polyominoes.maxWidth, self.stateHandler.polyominoes.maxHeight)